@@ -6,15 +6,47 @@
 #
 #
 
+import atexit
+import contextlib
 import errno
+import json
 import os
 import sys
+import threading
 
 from sys import stderr as stream
 
 # use kiB's
 kb = 1024
 
+# digests of the verification cache
+digest_algorithms = ('md5', 'sha1', 'sha256')
+digest_cache = {}
+digest_cache_lock = threading.RLock()
+# paths recorded since the last save_digest_cache
+digest_cache_dirty = set()
+
+# (total, downloaded) bytes of in flight transfers keyed by thread or transfer
+active_transfers = {}
+active_transfers_lock = threading.Lock()
+
+# download progress output, see configure_progress
+progress = {'mode': 'auto', 'interval': 0.5, 'last': 0.0, 'bytes': 0, 'last_bytes': 0, 'rate': 0.0,
+            'shown': False}
+
+# host wide content addressed artifact store
+artifact_store = {'enabled': True, 'max_size_mb': None}
+
+# see configure_download_durability
+download_durability = {'mode': 'file'}
+
+# CurlShare of all transfers
+https_share = None
+https_share_lock = threading.Lock()
+
+# host cache entries written by this process, see note_cache_write
+cache_writes = set()
+
 
 def check_python_version():
     if sys.version_info[1] < 7:
@@ -57,114 +89,748 @@ def make_sure_path_exists(path: str):
             raise
 
 
+def load_json_file(path: str) -> dict:
+    """Returns JSON object of path, empty if missing or invalid"""
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return {}
+
+
+def get_cache_folder() -> str:
+    """Returns host wide cache folder shared across workspaces"""
+    if 'FLUTTER_WORKSPACE_CACHE' in os.environ:
+        cache_folder = os.environ.get('FLUTTER_WORKSPACE_CACHE')
+    elif 'XDG_CACHE_HOME' in os.environ:
+        cache_folder = os.path.join(os.environ.get('XDG_CACHE_HOME'), 'flutter_workspace')
+    else:
+        # under sudo use the invoking user's home, so the cache stays usable by that user
+        home = os.path.expanduser('~%s' % os.environ.get('SUDO_USER', ''))
+        cache_folder = os.path.join(home, '.cache', 'flutter_workspace')
+
+    make_sure_path_exists(cache_folder)
+    return cache_folder
+
+
+def get_folder_size(path: str) -> int:
+    """Returns size in bytes of all files below path"""
+    total = 0
+    for root, _dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def clone_tree(src: str, dst: str):
+    """Copies src tree to dst sharing file data through reflinks (copy on write)
+    where the filesystem supports them.  Otherwise files are copied; a hardlink
+    would let an in place edit of one copy change the other"""
+    import platform
+    import shutil
+    import subprocess
+
+    if platform.system() == 'Darwin':
+        cmd = ['cp', '-c', '-R', '-p', src, dst]
+    else:
+        cmd = ['cp', '-a', '--reflink=always', src, dst]
+
+    if subprocess.call(cmd, stderr=subprocess.DEVNULL) == 0:
+        return
+
+    if os.path.exists(dst):
+        shutil.rmtree(dst)
+    shutil.copytree(src, dst, symlinks=True)
+
+
+def reflink_file(src: str, dst: str) -> bool:
+    """Creates dst sharing the file data of src (copy on write).  Returns False,
+    leaving no dst, where the filesystem doesn't support reflinks"""
+    import platform
+    import subprocess
+
+    if platform.system() == 'Darwin':
+        cmd = ['cp', '-c', '-p', src, dst]
+    else:
+        cmd = ['cp', '-p', '--reflink=always', src, dst]
+
+    if subprocess.call(cmd, stderr=subprocess.DEVNULL) == 0:
+        return True
+
+    if os.path.exists(dst):
+        os.remove(dst)
+    return False
+
+
+def clone_file(src: str, dst: str):
+    """Copies src to dst sharing file data through a reflink where the filesystem
+    supports them, a plain copy otherwise"""
+    import shutil
+
+    if not reflink_file(src, dst):
+        shutil.copy2(src, dst)
+
+
+def note_cache_write(path: str):
+    """Records a host cache entry, file or folder, written by this process.  A
+    run as root gives the recorded entries to the invoking user"""
+    cache_writes.add(path)
+
+
+@contextlib.contextmanager
+def file_lock(path: str, blocking=True):
+    """Exclusive advisory lock held for the duration of the with block.
+    Raises BlockingIOError if blocking is False and the lock is held elsewhere"""
+    import fcntl
+
+    note_cache_write(path)
+    with open(path, 'a+') as f:
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        fcntl.flock(f, flags)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def get_file_stamps(paths: list) -> dict:
+    """Returns path -> [size, mtime_ns] of each existing path"""
+    stamps = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        stamps[path] = [st.st_size, st.st_mtime_ns]
+    return stamps
+
+
+def is_file_stamps_current(stamps: dict) -> bool:
+    """True if stamps is not empty and every path still has its recorded size and mtime"""
+    if not stamps:
+        return False
+    return get_file_stamps(list(stamps.keys())) == stamps
+
+
 def get_md5sum(file: str) -> str:
     """Return md5sum of specified file"""
-    import hashlib
-
     if not os.path.exists(file):
         return ''
 
-    md5_hash = hashlib.md5()
-    with open(file, "rb") as f:
-        # Read and update hash in chunks of 4K
-        for byte_block in iter(lambda: f.read(4096), b""):
-            md5_hash.update(byte_block)
-
-    return md5_hash.hexdigest()
+    return get_file_digests(file, ['md5'])['md5']
 
 
 def get_sha1sum(file: str) -> str:
     """Return sha1sum of specified file"""
-    import hashlib
-
     if not os.path.exists(file):
         return ''
 
-    sha1_hash = hashlib.sha1()
-    with open(file, "rb") as f:
-        # Read and update hash in chunks of 4K
-        for byte_block in iter(lambda: f.read(4096), b""):
-            sha1_hash.update(byte_block)
-
-    return sha1_hash.hexdigest()
+    return get_file_digests(file, ['sha1'])['sha1']
 
 
 def get_sha256sum(file: str):
     """Return sha256sum of specified file"""
-    import hashlib
-
     if not os.path.exists(file):
         return ''
 
-    sha256_hash = hashlib.sha256()
+    return get_file_digests(file, ['sha256'])['sha256']
+
+
+# files at least this size are mapped instead of read
+digest_mmap_threshold = 8 * 1024 * kb
+digest_block_size = 8 * 1024 * kb
+
+
+def update_digest(h, view):
+    """Feeds view to hash h in blocks.  hashlib drops the GIL while hashing a block,
+    so hashes running in other threads proceed concurrently"""
+    for offset in range(0, len(view), digest_block_size):
+        h.update(view[offset:offset + digest_block_size])
+
+
+def get_file_digests(file: str, algorithms=digest_algorithms) -> dict:
+    """Returns hexdigest of each hashlib algorithm, computed in a single pass over file.
+    Large files are mapped and each algorithm hashes the mapping on its own thread"""
+    import concurrent.futures
+    import hashlib
+    import mmap
+
+    hashes = {}
+    for algorithm in algorithms:
+        hashes[algorithm] = hashlib.new(algorithm)
+
     with open(file, "rb") as f:
-        # Read and update hash in chunks of 4K
-        for byte_block in iter(lambda: f.read(4096), b""):
-            sha256_hash.update(byte_block)
+        size = os.fstat(f.fileno()).st_size
+        if size < digest_mmap_threshold:
+            # Read and update hashes in chunks of 1M
+            for byte_block in iter(lambda: f.read(1024 * kb), b""):
+                for h in hashes.values():
+                    h.update(byte_block)
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                if hasattr(m, 'madvise'):
+                    m.madvise(mmap.MADV_SEQUENTIAL)
+                view = memoryview(m)
+                try:
+                    # the pool is shut down before the view is released, result()
+                    # raises what a worker raised
+                    with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(hashes), 1)) as pool:
+                        futures = [pool.submit(update_digest, h, view) for h in hashes.values()]
+                        for future in futures:
+                            future.result()
+                finally:
+                    view.release()
+
+    digests = {}
+    for algorithm, h in hashes.items():
+        digests[algorithm] = h.hexdigest()
+    return digests
+
+
+def get_digest_cache_file() -> str:
+    return os.path.join(get_cache_folder(), 'digests.json')
+
+
+def load_digest_cache() -> dict:
+    return load_json_file(get_digest_cache_file())
+
+
+def get_file_digest_stamp(file: str) -> list:
+    st = os.stat(file)
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+def store_cached_digests(file: str, digests: dict, stamp=None):
+    """Records digests of file in the verification cache.  The cache file is
+    written by save_digest_cache"""
+    path = os.path.realpath(file)
+    if stamp is None:
+        stamp = get_file_digest_stamp(file)
+
+    with digest_cache_lock:
+        if not digest_cache:
+            digest_cache.update(load_digest_cache())
+        if path in digest_cache and digest_cache[path]['stamp'] == stamp:
+            digests = dict(digest_cache[path]['digests'], **digests)
+        digest_cache[path] = {'stamp': stamp, 'digests': digests}
+        digest_cache_dirty.add(path)
+
+
+@atexit.register
+def save_digest_cache():
+    """Writes the digests recorded by this process to the cache file, merged with
+    entries of other processes.  Entries of files that are gone or changed since
+    they were hashed are dropped"""
+    with digest_cache_lock:
+        if not digest_cache_dirty:
+            return
+
+        cache_file = get_digest_cache_file()
+        with file_lock(cache_file + '.lock'):
+            on_disk = load_digest_cache()
+            for path in digest_cache_dirty:
+                on_disk[path] = digest_cache[path]
+
+            for path, entry in list(on_disk.items()):
+                try:
+                    current = get_file_digest_stamp(path)
+                except OSError:
+                    current = None
+                if current != entry.get('stamp'):
+                    del on_disk[path]
+
+            tmp_file = '%s.%d' % (cache_file, os.getpid())
+            with open(tmp_file, 'w+') as f:
+                json.dump(on_disk, f)
+            os.replace(tmp_file, cache_file)
+            note_cache_write(cache_file)
+        digest_cache_dirty.clear()
+
+
+def get_cached_digests(file: str, algorithms=digest_algorithms) -> dict:
+    """Returns digests of file.  Keyed by (path, size, mtime_ns, inode), so an
+    unchanged file costs a stat() call.  On a miss all digest_algorithms are
+    computed in one pass.  Returns empty dict if file does not exist"""
+    try:
+        stamp = get_file_digest_stamp(file)
+    except FileNotFoundError:
+        return {}
 
-    return sha256_hash.hexdigest()
+    path = os.path.realpath(file)
+    with digest_cache_lock:
+        if not digest_cache:
+            digest_cache.update(load_digest_cache())
+        entry = digest_cache.get(path)
+        if entry and entry['stamp'] == stamp and all(a in entry['digests'] for a in algorithms):
+            return entry['digests']
 
+    digests = get_file_digests(file, sorted(set(digest_algorithms) | set(algorithms)))
 
-def download_https_file(cwd, url, file, cookie_file, netrc, md5, sha1, sha256, redirect=False, connect_timeout=None):
-    download_filepath = os.path.join(cwd, file)
+    # don't record a file that changed while it was hashed
+    if get_file_digest_stamp(file) == stamp:
+        store_cached_digests(file, digests, stamp)
+    return digests
+
+
+def configure_artifact_store(enabled=True, max_size_mb=None):
+    """Enables the artifact store and sets its size cap"""
+    artifact_store['enabled'] = enabled is not False
+    artifact_store['max_size_mb'] = max_size_mb
+
+
+def is_artifact_store_enabled() -> bool:
+    return artifact_store['enabled']
+
+
+def get_artifact_store_folder() -> str:
+    return os.path.join(get_cache_folder(), 'artifacts')
+
+
+def get_url_artifact_key(url: str, validator: str) -> str:
+    """Returns store key of url as of validator, a strong ETag, Last-Modified, or
+    'immutable' for a url that always names the same content"""
+    import hashlib
+    return 'url-%s' % hashlib.sha256(('%s\n%s' % (url, validator)).encode('utf-8')).hexdigest()
+
+
+def get_artifact_keys(url=None, md5=None, sha1=None, sha256=None, validator=None) -> list:
+    """Returns store keys of an artifact.  The url is only a key when no digest is
+    known, and only together with a validator"""
+    keys = []
+    if sha256:
+        keys.append('sha256-%s' % sha256)
+    if md5:
+        keys.append('md5-%s' % md5)
+    if sha1:
+        keys.append('sha1-%s' % sha1)
+    if not keys and url and validator:
+        keys.append(get_url_artifact_key(url, validator))
+    return keys
+
+
+def get_https_validator(url, redirect, headers, cookie_file, netrc, connect_timeout=None):
+    """Returns the current strong ETag, or else Last-Modified, of url from a HEAD
+    request.  None if the server sends neither"""
+    import pycurl
+
+    response = {}
+
+    def header(line):
+        line = line.decode('iso-8859-1').strip()
+        if line.startswith('HTTP/'):
+            response.clear()
+            response['status'] = int(line.split()[1])
+        elif ':' in line:
+            name, value = line.split(':', 1)
+            response[name.strip().lower()] = value.strip()
 
-    sha256_file = os.path.join(cwd, file + '.sha256')
-    if compare_sha256(download_filepath, sha256_file):
+    c = pycurl.Curl()
+    c.setopt(pycurl.URL, url)
+    setup_https_handle(c, headers, cookie_file, netrc, connect_timeout)
+    c.setopt(pycurl.NOBODY, 1)
+    c.setopt(pycurl.HEADERFUNCTION, header)
+    if redirect:
+        c.setopt(pycurl.FOLLOWLOCATION, 1)
+        c.setopt(pycurl.AUTOREFERER, 1)
+        c.setopt(pycurl.MAXREDIRS, 255)
+
+    try:
+        c.perform()
+    except pycurl.error:
+        return None
+    finally:
+        c.close()
+
+    return get_response_validator(response) if response.get('status') == 200 else None
+
+
+def get_response_validator(response: dict):
+    """Returns strong ETag, or else Last-Modified, of a response or part validator"""
+    etag = response.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.get('last-modified', response.get('last_modified'))
+
+
+def find_artifact(url=None, md5=None, sha1=None, sha256=None, validator=None) -> str:
+    """Returns path of an intact stored artifact matching the given digest, or url
+    as of validator.  Empty string if there is none"""
+    import time
+
+    if not artifact_store['enabled']:
+        return ''
+
+    store = get_artifact_store_folder()
+    for key in get_artifact_keys(url, md5, sha1, sha256, validator):
+        try:
+            with open(os.path.join(store, 'keys', key), 'r') as f:
+                object_sha256 = f.read().strip()
+        except FileNotFoundError:
+            continue
+
+        obj = os.path.join(store, 'objects', object_sha256)
+        digests = get_cached_digests(obj, ['sha256'])
+        if not digests:
+            continue
+        if digests.get('sha256') != object_sha256:
+            # corrupted on disk
+            os.remove(obj)
+            continue
+
+        # access time orders eviction; mtime is left alone so the digest stays cached
+        st = os.stat(obj)
+        os.utime(obj, ns=(time.time_ns(), st.st_mtime_ns))
+        return obj
+
+    return ''
+
+
+def restore_artifact(dest: str, url=None, md5=None, sha1=None, sha256=None, validator=None) -> bool:
+    """Materializes a stored artifact matching the given digest, or url as of
+    validator, at dest.  Returns False if the store has no intact copy"""
+    obj = find_artifact(url, md5, sha1, sha256, validator)
+    if not obj:
+        return False
+
+    make_sure_path_exists(os.path.dirname(dest))
+    if os.path.exists(dest):
+        os.remove(dest)
+    clone_file(obj, dest)
+    store_cached_digests(dest, get_cached_digests(obj, ['sha256']))
+    print("** Using %s from artifact store" % dest)
+    return True
+
+
+def store_artifact(file: str, url=None, md5=None, sha1=None, validator=None, move=False):
+    """Adds file to the artifact store keyed by its digests, and url as of
+    validator if there is one.  The stored copy is a reflink, so it costs no space
+    of its own; where the filesystem can't reflink, file is only stored if move
+    allows taking it over"""
+    if not artifact_store['enabled'] or not os.path.exists(file):
+        return
+
+    digests = dict(get_cached_digests(file, ['sha256']))
+    if md5:
+        digests.setdefault('md5', md5)
+    if sha1:
+        digests.setdefault('sha1', sha1)
+
+    store = get_artifact_store_folder()
+    make_sure_path_exists(os.path.join(store, 'objects'))
+    make_sure_path_exists(os.path.join(store, 'keys'))
+
+    obj = os.path.join(store, 'objects', digests['sha256'])
+    if not os.path.exists(obj):
+        tmp_file = '%s.%d.%d' % (obj, os.getpid(), threading.get_ident())
+        if reflink_file(file, tmp_file):
+            os.replace(tmp_file, obj)
+        elif move:
+            try:
+                os.replace(file, obj)
+            except OSError:
+                # another filesystem
+                return
+        else:
+            # a full copy would double the disk use of every download
+            return
+        note_cache_write(obj)
+
+    keys = get_artifact_keys(None, digests.get('md5'), digests.get('sha1'), digests['sha256'])
+    if url and validator:
+        keys.append(get_url_artifact_key(url, validator))
+    for key in keys:
+        key_file = os.path.join(store, 'keys', key)
+        tmp_file = '%s.%d.%d' % (key_file, os.getpid(), threading.get_ident())
+        with open(tmp_file, 'w+') as f:
+            f.write(digests['sha256'])
+        os.replace(tmp_file, key_file)
+        note_cache_write(key_file)
+
+    prune_artifact_store()
+
+
+def prune_artifact_store():
+    """Evicts least recently used artifacts until the store is below its size cap"""
+    max_size_mb = artifact_store['max_size_mb']
+    if not max_size_mb:
+        return
+
+    store = get_artifact_store_folder()
+    try:
+        with file_lock(os.path.join(store, '.lock'), blocking=False):
+            objects = []
+            total = 0
+            for entry in os.scandir(os.path.join(store, 'objects')):
+                if '.' in entry.name:
+                    continue
+                st = entry.stat()
+                objects.append((st.st_atime_ns, st.st_size, entry.path))
+                total += st.st_size
+
+            max_size = int(max_size_mb) * kb * kb
+            for _last_used, size, obj in sorted(objects):
+                if total <= max_size:
+                    break
+                print('Evicting artifact %s' % obj)
+                os.remove(obj)
+                total -= size
+
+            # drop keys of evicted artifacts
+            for entry in os.scandir(os.path.join(store, 'keys')):
+                if '.' in entry.name:
+                    continue
+                with open(entry.path, 'r') as f:
+                    object_sha256 = f.read().strip()
+                if not os.path.exists(os.path.join(store, 'objects', object_sha256)):
+                    os.remove(entry.path)
+    except BlockingIOError:
+        return
+
+
+def is_download_current(download_filepath: str, md5, sha1, sha256) -> bool:
+    """True if download_filepath exists and matches its .sha256 file or the given digest.
+    A file that doesn't match the digest is removed"""
+    if compare_sha256(download_filepath, download_filepath + '.sha256'):
         print("%s exists, skipping download" % download_filepath)
         return True
 
     if os.path.exists(download_filepath):
+        digests = get_cached_digests(download_filepath)
         if md5:
             # don't download if md5 is good
-            if md5 == get_md5sum(download_filepath):
+            if md5 == digests.get('md5'):
                 print("** Using %s" % download_filepath)
                 return True
             else:
                 os.remove(download_filepath)
         elif sha1:
             # don't download if sha1 is good
-            if sha1 == get_sha1sum(download_filepath):
+            if sha1 == digests.get('sha1'):
                 print("** Using %s" % download_filepath)
                 return True
             else:
                 os.remove(download_filepath)
         elif sha256:
             # don't download if sha256 is good
-            if sha256 == get_sha256sum(download_filepath):
+            if sha256 == digests.get('sha256'):
                 print("** Using %s" % download_filepath)
                 return True
             else:
                 os.remove(download_filepath)
 
+    return False
+
+
+def verify_download(download_filepath: str, url, md5, sha1, sha256):
+    """Checks the completed part file of download_filepath against the given digest
+    before it takes the final name, writes the .sha256 file and adds it to the
+    artifact store"""
+    part_file = get_part_file(download_filepath)
+    digests = get_file_digests(part_file)
+    validator = get_response_validator(load_part_validator(part_file))
+    if md5:
+        expected_md5 = digests.get('md5')
+        if md5 != expected_md5:
+            remove_part_file(part_file)
+            sys.exit('Download artifact %s md5: %s does not match expected: %s' %
+                     (download_filepath, md5, expected_md5))
+    elif sha1:
+        expected_sha1 = digests.get('sha1')
+        if sha1 != expected_sha1:
+            remove_part_file(part_file)
+            sys.exit('Download artifact %s sha1: %s does not match expected: %s' %
+                     (download_filepath, sha1, expected_sha1))
+    elif sha256:
+        expected_sha256 = digests.get('sha256')
+        if sha256 != expected_sha256:
+            remove_part_file(part_file)
+            sys.exit('Download artifact %s sha256: %s does not match expected: %s' %
+                     (download_filepath, sha256, expected_sha256))
+
+    commit_part_file(part_file, download_filepath)
+    store_cached_digests(download_filepath, digests)
+
+    write_sha256_file(os.path.dirname(download_filepath), os.path.basename(download_filepath))
+    store_artifact(download_filepath, url, validator=validator)
+
+
+def restore_https_artifact(download_filepath: str, url, md5, sha1, sha256, redirect, cookie_file, netrc,
+                           connect_timeout=None) -> bool:
+    """restore_artifact of a download.  Without a digest the stored copy of url is
+    only used while the url still has the ETag or Last-Modified it was stored with"""
+    validator = None
+    if not (md5 or sha1 or sha256) and is_artifact_store_enabled():
+        validator = get_https_validator(url, redirect, None, cookie_file, netrc, connect_timeout)
+    return restore_artifact(download_filepath, url, md5, sha1, sha256, validator)
+
+
+def download_https_file(cwd, url, file, cookie_file, netrc, md5, sha1, sha256, redirect=False, connect_timeout=None,
+                        segments=None):
+    download_filepath = os.path.join(cwd, file)
+
+    if is_download_current(download_filepath, md5, sha1, sha256):
+        return True
+
+    if restore_https_artifact(download_filepath, url, md5, sha1, sha256, redirect, cookie_file, netrc,
+                              connect_timeout):
+        write_sha256_file(cwd, file)
+        return True
+
     print("** Downloading %s via %s" % (file, url))
-    res = fetch_https_binary_file(
-        url, download_filepath, redirect, None, cookie_file, netrc, connect_timeout)
+    part_file = get_part_file(download_filepath)
+    res = None
+    if segments and segments > 1:
+        res = fetch_https_segmented_file(
+            url, part_file, segments, redirect, None, cookie_file, netrc, connect_timeout)
+    if res is None:
+        res = fetch_https_part_file(
+            url, part_file, redirect, None, cookie_file, netrc, connect_timeout)
     if not res:
-        os.remove(download_filepath)
+        # the partial download is kept, next run resumes it
         print_banner("Failed to download %s" % file)
         return False
 
-    if os.path.exists(download_filepath):
-        if md5:
-            expected_md5 = get_md5sum(download_filepath)
-            if md5 != expected_md5:
-                sys.exit('Download artifact %s md5: %s does not match expected: %s' %
-                         (download_filepath, md5, expected_md5))
-        elif sha1:
-            expected_sha1 = get_sha1sum(download_filepath)
-            if sha1 != expected_sha1:
-                sys.exit('Download artifact %s sha1: %s does not match expected: %s' %
-                         (download_filepath, md5, expected_sha1))
-        elif sha256:
-            expected_sha256 = get_sha256sum(download_filepath)
-            if sha256 != expected_sha256:
-                sys.exit('Download artifact %s sha256: %s does not match expected: %s' %
-                         (download_filepath, sha256, expected_sha256))
-
-    write_sha256_file(cwd, file)
+    verify_download(download_filepath, url, md5, sha1, sha256)
     return True
 
 
+def download_https_files(cwd, downloads, cookie_file, netrc, max_transfers=8, connect_timeout=None,
+                         on_done=None) -> dict:
+    """Downloads a list of dicts with url, file, md5, sha1, sha256, segments and
+    redirect keys into cwd.  Transfers run on one CurlMulti, at most max_transfers
+    at a time, sharing connections and TLS sessions and multiplexed over HTTP/2
+    where the server supports it.  Segmented downloads run after the batch.
+    Completed files are hashed and committed on worker threads, so verifying a
+    large file doesn't stall the other transfers.  on_done(file, result) is
+    called as each is verified.  Returns dict of file to result"""
+    import concurrent.futures
+    import pycurl
+    import time
+
+    results = {}
+    queue = []
+    segmented = []
+    for download in downloads:
+        download_filepath = os.path.join(cwd, download['file'])
+        if (is_download_current(download_filepath, download.get('md5'), download.get('sha1'),
+                                download.get('sha256')) or
+                restore_https_artifact(download_filepath, download['url'], download.get('md5'), download.get('sha1'),
+                                       download.get('sha256'), download.get('redirect'), cookie_file, netrc,
+                                       connect_timeout)):
+            write_sha256_file(cwd, download['file'])
+            results[download['file']] = True
+            if on_done:
+                on_done(download['file'], True)
+        elif download.get('segments') and download['segments'] > 1:
+            segmented.append(download)
+        else:
+            download['retries_left'] = 3
+            download['not_before'] = 0
+            queue.append(download)
+
+    if cookie_file:
+        print("Using cookie file: %s" % os.path.expandvars(cookie_file))
+
+    def verify(download, result):
+        if result:
+            verify_download(os.path.join(cwd, download['file']), download['url'], download.get('md5'),
+                            download.get('sha1'), download.get('sha256'))
+        else:
+            # the partial download is kept, next run resumes it
+            print_banner("Failed to download %s" % download['file'])
+        results[download['file']] = result
+        if on_done:
+            on_done(download['file'], result)
+
+    verifier = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    verifications = []
+
+    def done(download, result):
+        verifications.append(verifier.submit(verify, download, result))
+
+    m = pycurl.CurlMulti()
+    m.setopt(pycurl.M_MAX_TOTAL_CONNECTIONS, max_transfers)
+    if hasattr(pycurl, 'PIPE_MULTIPLEX'):
+        m.setopt(pycurl.M_PIPELINING, pycurl.PIPE_MULTIPLEX)
+
+    delay_between_retries = 5  # seconds
+    active = {}
+    while queue or active:
+        now = time.monotonic()
+        for download in list(queue):
+            if len(active) >= max_transfers:
+                break
+            if download['not_before'] > now:
+                continue
+            queue.remove(download)
+            print("** Downloading %s via %s" % (download['file'], download['url']))
+            c = pycurl.Curl()
+            c.setopt(pycurl.URL, download['url'])
+            setup_https_handle(c, None, cookie_file, netrc, connect_timeout)
+            if download.get('redirect'):
+                c.setopt(pycurl.FOLLOWLOCATION, 1)
+                c.setopt(pycurl.AUTOREFERER, 1)
+                c.setopt(pycurl.MAXREDIRS, 255)
+            part_file = get_part_file(os.path.join(cwd, download['file']))
+            active[c] = (download, start_part_transfer(c, download['url'], part_file, None))
+            m.add_handle(c)
+
+        while True:
+            ret, _num_handles = m.perform()
+            if ret != pycurl.E_CALL_MULTI_PERFORM:
+                break
+
+        while True:
+            queued, ok_list, err_list = m.info_read()
+            for c, error in [(c, False) for c in ok_list] + [(c, True) for c, _errno, _msg in err_list]:
+                download, transfer = active.pop(c)
+                m.remove_handle(c)
+                result, status = finish_part_transfer(transfer, error)
+                c.close()
+                if result == 'done':
+                    done(download, check_part_transfer_status(transfer['part_file'], status,
+                                                              download.get('redirect')))
+                    continue
+                if result == 'retry':
+                    download['retries_left'] -= 1
+                if download['retries_left'] > 0:
+                    print('curl retry %s' % download['file'])
+                    download['not_before'] = time.monotonic() + delay_between_retries
+                    queue.append(download)
+                else:
+                    check_part_transfer_status(transfer['part_file'], status, download.get('redirect'))
+                    done(download, False)
+            if not queued:
+                break
+
+        if active:
+            m.select(1.0)
+        elif queue:
+            time.sleep(max(0.0, min(d['not_before'] for d in queue) - time.monotonic()))
+
+    m.close()
+
+    # raises a failed verification
+    for future in verifications:
+        future.result()
+    verifier.shutdown()
+
+    for download in segmented:
+        result = download_https_file(cwd, download['url'], download['file'], cookie_file, netrc,
+                                     download.get('md5'), download.get('sha1'), download.get('sha256'),
+                                     download.get('redirect', False), connect_timeout, download['segments'])
+        results[download['file']] = result
+        if on_done:
+            on_done(download['file'], result)
+
+    return results
+
+
 def compare_sha256(archive_path: str, sha256_file: str) -> bool:
     if not os.path.exists(archive_path):
         return False
@@ -172,7 +838,7 @@ def compare_sha256(archive_path: str, sha256_file: str) -> bool:
     if not os.path.exists(sha256_file):
         return False
 
-    archive_sha256_val = get_sha256sum(archive_path)
+    archive_sha256_val = get_cached_digests(archive_path, ['sha256']).get('sha256')
 
     with open(sha256_file, 'r') as f:
         sha256_file_val = f.read().replace('\n', '')
@@ -185,80 +851,798 @@ def compare_sha256(archive_path: str, sha256_file: str) -> bool:
 
 def write_sha256_file(cwd: str, filename: str):
     file = os.path.join(cwd, filename)
-    sha256_val = get_sha256sum(file)
+    sha256_val = get_cached_digests(file, ['sha256']).get('sha256', '')
     sha256_file = os.path.join(cwd, filename + '.sha256')
 
     with open(sha256_file, 'w+') as f:
         f.write(sha256_val)
 
 
-def fetch_https_progress(download_t, download_d, _upload_t, _upload_d):
-    """callback function for pycurl.XFERINFOFUNCTION"""
-    stream.write('Progress: {}/{} kiB ({}%)\r'.format(str(int(download_d / kb)), str(int(download_t / kb)),
-                                                      str(int(download_d / download_t * 100) if download_t > 0 else 0)))
+def configure_progress(mode='auto', interval=None):
+    """Sets download progress output.  'line' rewrites one line, 'json' writes a JSON
+    object per sample, 'none' is quiet, and 'auto' is 'line' if stdout is a TTY and
+    quiet otherwise"""
+    if mode not in ['auto', 'line', 'json', 'none']:
+        sys.exit('Invalid download_progress: %s' % mode)
+    progress['mode'] = mode
+    if interval:
+        progress['interval'] = float(interval)
+
+
+def get_progress_mode() -> str:
+    if progress['mode'] == 'auto':
+        return 'line' if sys.stdout.isatty() else 'none'
+    return progress['mode']
+
+
+def report_https_progress(now):
+    """Writes one sample of all active transfers.  Called with active_transfers_lock held"""
+    import json
+
+    download_t = sum(t for t, _d in active_transfers.values())
+    download_d = sum(d for _t, d in active_transfers.values())
+    count = len(active_transfers)
+
+    elapsed = now - progress['last']
+    if elapsed > 0:
+        # smoothed transfer rate
+        rate = (progress['bytes'] - progress['last_bytes']) / elapsed
+        progress['rate'] = rate if not progress['rate'] else 0.7 * progress['rate'] + 0.3 * rate
+    progress['last'] = now
+    progress['last_bytes'] = progress['bytes']
+
+    eta = None
+    if progress['rate'] > 0 and download_t >= download_d:
+        eta = int((download_t - download_d) / progress['rate'])
+
+    if get_progress_mode() == 'json':
+        stream.write(json.dumps({'transfers': count, 'downloaded': download_d, 'total': download_t,
+                                 'rate': int(progress['rate']), 'eta': eta}) + '\n')
+    else:
+        stream.write('Progress: {}/{} kiB ({}%) {} transfer(s) {} kiB/s ETA {}\x1b[K\r'.format(
+            int(download_d / kb), int(download_t / kb),
+            int(download_d / download_t * 100) if download_t > 0 else 0, count,
+            int(progress['rate'] / kb), '%d:%02d' % divmod(eta, 60) if eta is not None else '-'))
+        progress['shown'] = True
     stream.flush()
 
 
-def fetch_https_binary_file(url, filename, redirect, headers, cookie_file, netrc, connect_timeout) -> bool:
-    """Fetches binary file via HTTPS"""
+def update_https_progress(key, download_t, download_d):
+    """Records (total, downloaded) bytes of transfer key.  Called at libcurl's rate;
+    all active transfers are reported together at most once per progress interval"""
+    import time
+
+    with active_transfers_lock:
+        _total, previous = active_transfers.get(key, (0, 0))
+        if download_d > previous:
+            progress['bytes'] += download_d - previous
+        active_transfers[key] = (download_t, download_d)
+
+        now = time.monotonic()
+        if now - progress['last'] < progress['interval'] or get_progress_mode() == 'none':
+            return
+        report_https_progress(now)
+
+
+def fetch_https_progress(download_t, download_d, _upload_t, _upload_d):
+    """callback function for pycurl.XFERINFOFUNCTION.  Reports the sum of all active transfers"""
+    update_https_progress(threading.get_ident(), download_t, download_d)
+
+
+def end_https_progress(key=None):
+    """Removes transfer key, by default that of the calling thread, from progress.
+    Ends the progress line once no transfer is active"""
+    import time
+
+    with active_transfers_lock:
+        active_transfers.pop(threading.get_ident() if key is None else key, None)
+        if active_transfers:
+            return
+
+        # the rate of the next batch starts over
+        progress.update({'last': time.monotonic(), 'last_bytes': progress['bytes'], 'rate': 0.0})
+        if progress['shown']:
+            stream.write('\n')
+            stream.flush()
+            progress['shown'] = False
+
+
+def get_part_file(filename: str) -> str:
+    """Returns path an in progress download of filename is written to"""
+    return filename + '.part'
+
+
+def get_part_validator_file(part_file: str) -> str:
+    return part_file + '.json'
+
+
+def load_part_validator(part_file: str) -> dict:
+    """Returns url, etag and last_modified recorded for part_file"""
+    return load_json_file(get_part_validator_file(part_file))
+
+
+def save_part_validator(part_file: str, validator: dict):
+    with open(get_part_validator_file(part_file), 'w+') as f:
+        json.dump(validator, f)
+
+
+def remove_part_file(part_file: str):
+    for file in [part_file, get_part_validator_file(part_file)]:
+        if os.path.exists(file):
+            os.remove(file)
+
+
+def configure_download_durability(mode='file'):
+    """Sets how completed downloads are flushed.  'file' fsyncs each file and its
+    folder, 'sync' flushes the whole system, 'none' relies on atomic rename"""
+    if mode not in ['none', 'file', 'sync']:
+        sys.exit('Invalid download_durability: %s' % mode)
+    download_durability['mode'] = mode
+
+
+def get_download_settings() -> dict:
+    """Returns the configure_* settings, to hand over to a child process"""
+    return {'artifact_store': dict(artifact_store),
+            'download_durability': dict(download_durability),
+            'progress': {'mode': progress['mode'], 'interval': progress['interval']}}
+
+
+def apply_download_settings(settings: dict):
+    """Applies settings returned by get_download_settings"""
+    artifact_store.update(settings['artifact_store'])
+    download_durability.update(settings['download_durability'])
+    progress.update(settings['progress'])
+
+
+def fsync_path(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sync_download(filename: str):
+    """Makes a completed download durable per the configured mode"""
+    mode = download_durability['mode']
+    if mode == 'file':
+        fsync_path(filename)
+        fsync_path(os.path.dirname(os.path.abspath(filename)))
+    elif mode == 'sync':
+        os.sync()
+
+
+def commit_part_file(part_file: str, filename: str):
+    """Moves a completed download to its final name"""
+    if download_durability['mode'] == 'file':
+        # data reaches disk before the name does
+        fsync_path(part_file)
+    os.replace(part_file, filename)
+    if download_durability['mode'] == 'file':
+        fsync_path(os.path.dirname(os.path.abspath(filename)))
+    elif download_durability['mode'] == 'sync':
+        os.sync()
+    validator_file = get_part_validator_file(part_file)
+    if os.path.exists(validator_file):
+        os.remove(validator_file)
+
+
+def get_part_resume_offset(url: str, part_file: str) -> (int, str):
+    """Returns (offset, If-Range value) to resume part_file from.  A partial download
+    of another url, or one without a strong ETag or Last-Modified to validate
+    against, is discarded"""
+    if not os.path.exists(part_file):
+        return 0, None
+
+    validator = load_part_validator(part_file)
+    if_range = None
+    if validator.get('url') == url and 'segments' not in validator:
+        etag = validator.get('etag')
+        if etag and not etag.startswith('W/'):
+            if_range = etag
+        elif validator.get('last_modified'):
+            if_range = validator.get('last_modified')
+
+    if if_range is None:
+        remove_part_file(part_file)
+        return 0, None
+
+    return os.path.getsize(part_file), if_range
+
+
+def get_response_size(response: dict):
+    """Returns full length of a response from its Content-Range, or Content-Length of
+    a 200.  None if unknown"""
+    content_range = response.get('content-range', '')
+    if '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+        return int(total) if total.isdigit() else None
+    if response.get('status') == 200 and response.get('content-length', '').isdigit():
+        return int(response['content-length'])
+    return None
+
+
+def start_part_transfer(c, url: str, part_file: str, headers) -> dict:
+    """Points the write callback of Curl handle c at part_file.  An existing partial
+    download is resumed with a Range request validated by If-Range; if the
+    resource changed the server sends it whole and the partial content is
+    replaced.  Returns the transfer state for finish_part_transfer"""
+    import pycurl
+
+    offset, if_range = get_part_resume_offset(url, part_file)
+    if offset:
+        print("** Resuming %s at %d kiB" % (part_file, int(offset / kb)))
+
+    # a Range header rather than RESUME_FROM, so libcurl accepts the full
+    # 200 response If-Range falls back to
+    request_headers = list(headers or [])
+    if if_range:
+        request_headers.append('Range: bytes=%d-' % offset)
+        request_headers.append('If-Range: %s' % if_range)
+    if request_headers:
+        c.setopt(pycurl.HTTPHEADER, request_headers)
+    else:
+        # an empty list keeps the Range of an earlier attempt on a reused handle
+        c.unsetopt(pycurl.HTTPHEADER)
+
+    # status and validators of the last response; earlier ones are redirects
+    response = {}
+    f = open(part_file, 'ab')
+    transfer = {'part_file': part_file, 'file': f, 'offset': offset, 'response': response}
+
+    def header(line):
+        line = line.decode('iso-8859-1').strip()
+        if line.startswith('HTTP/'):
+            response.clear()
+            response['status'] = int(line.split()[1])
+        elif ':' in line:
+            name, value = line.split(':', 1)
+            response[name.strip().lower()] = value.strip()
+
+    def write(chunk):
+        status = response.get('status')
+        if status not in [200, 206]:
+            # error page, e.g. of a 416; not content
+            return None
+        if 'body' not in response:
+            response['body'] = True
+            if status == 200:
+                # resource changed, or the server ignored the range
+                f.seek(0)
+                f.truncate()
+                save_part_validator(part_file, {'url': url, 'etag': response.get('etag'),
+                                                'last_modified': response.get('last-modified'),
+                                                'size': get_response_size(response)})
+        f.write(chunk)
+
+    c.setopt(pycurl.NOPROGRESS, False)
+    c.setopt(pycurl.XFERINFOFUNCTION,
+             lambda download_t, download_d, _upload_t, _upload_d:
+             update_https_progress(id(transfer), download_t + offset if download_t else 0, download_d + offset))
+    c.setopt(pycurl.HEADERFUNCTION, header)
+    c.setopt(pycurl.WRITEFUNCTION, write)
+    return transfer
+
+
+def finish_part_transfer(transfer: dict, error: bool) -> (str, int):
+    """Closes a transfer of start_part_transfer.  Returns (result, status); result is
+    'done', 'retry', or 'resume' for a failed transfer that made progress and
+    doesn't use up a retry"""
+    f = transfer['file']
+    size = f.tell()
+    f.close()
+    end_https_progress(id(transfer))
+
+    status = transfer['response'].get('status', 0)
+    if error:
+        return ('resume' if size > transfer['offset'] else 'retry'), status
+
+    if status == 416:
+        full_size = get_response_size(transfer['response'])
+        if full_size is None:
+            full_size = load_part_validator(transfer['part_file']).get('size')
+        if transfer['offset'] and size == transfer['offset'] == full_size:
+            # partial content is already complete
+            return 'done', 206
+
+        # range not satisfiable; partial content is stale
+        remove_part_file(transfer['part_file'])
+        return 'retry', status
+
+    return 'done', status
+
+
+def check_part_transfer_status(part_file: str, status: int, redirect) -> bool:
+    """Returns True for a successful final status.  Exits on failure, except for an
+    unfollowed redirect"""
+    if not redirect and status == 302:
+        print_banner("Download Status: %d" % status)
+        return False
+    if status not in [200, 206]:
+        remove_part_file(part_file)
+        print_banner("Download Status: %d" % status)
+        sys.exit('Download Failed')
+
+    return True
+
+
+def fetch_https_part_file(url, part_file, redirect, headers, cookie_file, netrc, connect_timeout=None) -> bool:
+    """Fetches binary file via HTTPS into part_file.  Retries, and later runs, resume
+    the partial download"""
     import pycurl
     import time
 
     retries_left = 3
     delay_between_retries = 5  # seconds
     success = False
+    status = 0
+
+    if cookie_file:
+        print("Using cookie file: %s" % os.path.expandvars(cookie_file))
 
     c = pycurl.Curl()
     c.setopt(pycurl.URL, url)
+    setup_https_handle(c, None, cookie_file, netrc, connect_timeout)
+
+    if redirect:
+        c.setopt(pycurl.FOLLOWLOCATION, 1)
+        c.setopt(pycurl.AUTOREFERER, 1)
+        c.setopt(pycurl.MAXREDIRS, 255)
+
+    while retries_left > 0:
+        transfer = start_part_transfer(c, url, part_file, headers)
+        error = False
+        try:
+            c.perform()
+        except pycurl.error:
+            error = True
+
+        result, status = finish_part_transfer(transfer, error)
+        if result == 'done':
+            success = True
+            break
+
+        if result == 'retry':
+            retries_left -= 1
+        print('curl retry')
+        time.sleep(delay_between_retries)
+
+    c.close()
+
+    return check_part_transfer_status(part_file, status, redirect) and success
+
+
+# smallest byte range worth a segment of its own
+segment_min_size = 4 * 1024 * kb
+
+
+def get_https_share():
+    """Returns the CurlShare of all transfers, so DNS lookups and TLS sessions are
+    reused across files.  Transfers run on several threads at once, so the
+    connection cache, which libcurl can't share between threads, is not shared;
+    the handles of one CurlMulti already share its connections"""
+    import pycurl
+
+    global https_share
+    with https_share_lock:
+        if https_share is None:
+            https_share = pycurl.CurlShare()
+            https_share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+            https_share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+        return https_share
+
+
+def setup_https_handle(c, headers, cookie_file, netrc, connect_timeout):
+    """Common options of download handles.  HTTP/2 is negotiated where supported,
+    waiting for a connection that can multiplex rather than opening another"""
+    import pycurl
+
+    c.setopt(pycurl.SHARE, get_https_share())
+    if hasattr(pycurl, 'CURL_HTTP_VERSION_2TLS'):
+        c.setopt(pycurl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_2TLS)
+        c.setopt(pycurl.PIPEWAIT, 1)
     if connect_timeout is not None:
         c.setopt(pycurl.CONNECTTIMEOUT, connect_timeout)
     c.setopt(pycurl.NOSIGNAL, 1)
-    c.setopt(pycurl.NOPROGRESS, False)
-    c.setopt(pycurl.XFERINFOFUNCTION, fetch_https_progress)
-
     if headers:
         c.setopt(pycurl.HTTPHEADER, headers)
+    if cookie_file:
+        c.setopt(pycurl.COOKIEFILE, os.path.expandvars(cookie_file))
+    if netrc:
+        c.setopt(pycurl.NETRC, 1)
+
+
+def probe_https_ranges(url, redirect, headers, cookie_file, netrc, connect_timeout) -> dict:
+    """Requests the first byte of url.  Returns effective url, size, etag and
+    last_modified if the server honours Range, otherwise empty dict"""
+    import pycurl
+
+    response = {}
+
+    def header(line):
+        line = line.decode('iso-8859-1').strip()
+        if line.startswith('HTTP/'):
+            response.clear()
+        elif ':' in line:
+            name, value = line.split(':', 1)
+            response[name.strip().lower()] = value.strip()
 
+    c = pycurl.Curl()
+    c.setopt(pycurl.URL, url)
+    setup_https_handle(c, headers, cookie_file, netrc, connect_timeout)
+    c.setopt(pycurl.RANGE, '0-0')
+    c.setopt(pycurl.HEADERFUNCTION, header)
+    c.setopt(pycurl.WRITEFUNCTION, lambda chunk: None)
     if redirect:
         c.setopt(pycurl.FOLLOWLOCATION, 1)
         c.setopt(pycurl.AUTOREFERER, 1)
         c.setopt(pycurl.MAXREDIRS, 255)
 
-    if cookie_file:
-        cookie_file = os.path.expandvars(cookie_file)
-        print("Using cookie file: %s" % cookie_file)
-        c.setopt(pycurl.COOKIEFILE, cookie_file)
+    try:
+        c.perform()
+        status = c.getinfo(pycurl.HTTP_CODE)
+        effective_url = c.getinfo(pycurl.EFFECTIVE_URL)
+    except pycurl.error:
+        return {}
+    finally:
+        c.close()
+
+    content_range = response.get('content-range', '')
+    if status != 206 or not content_range.startswith('bytes 0-0/'):
+        return {}
+    size = content_range.split('/')[1]
+    if not size.isdigit():
+        return {}
+
+    return {'url': effective_url, 'size': int(size),
+            'etag': response.get('etag'), 'last_modified': response.get('last-modified')}
+
+
+def get_segments(size: int, count: int) -> list:
+    """Splits size bytes into at most count [offset, end] ranges, end exclusive"""
+    count = max(1, min(count, size // segment_min_size))
+    length = -(-size // count)
+    return [[offset, min(offset + length, size)] for offset in range(0, size, length)]
+
+
+def fetch_https_segmented_file(url, part_file, segments, redirect, headers, cookie_file, netrc,
+                               connect_timeout=None):
+    """Fetches url into part_file as concurrent byte ranges on one CurlMulti, each
+    written with pwrite into the preallocated file.  Segment offsets are recorded
+    on failure so a later run resumes them.  Returns None if the server lacks
+    Range support or the file is too small to split; caller falls back to a
+    single stream"""
+    import pycurl
+    import time
 
-    if netrc:
-        c.setopt(pycurl.NETRC, 1)
+    probe = probe_https_ranges(url, redirect, headers, cookie_file, netrc, connect_timeout)
+    if not probe or probe['size'] < 2 * segment_min_size:
+        return None
+
+    etag = probe['etag']
+    if etag and etag.startswith('W/'):
+        etag = None
+    if_range = etag or probe['last_modified']
+    if not if_range:
+        return None
+
+    size = probe['size']
+    validator = load_part_validator(part_file)
+    if (validator.get('url') == url and validator.get('size') == size and
+            validator.get('etag') == probe['etag'] and validator.get('last_modified') == probe['last_modified'] and
+            validator.get('segments') and os.path.exists(part_file)):
+        ranges = validator['segments']
+        print("** Resuming %s at %d kiB" % (part_file, int((size - sum(e - o for o, e in ranges)) / kb)))
+    else:
+        remove_part_file(part_file)
+        ranges = get_segments(size, segments)
+
+    fd = os.open(part_file, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if os.fstat(fd).st_size != size:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, 0, size)
+            else:
+                os.ftruncate(fd, size)
+
+        retries_left = 3 * len(ranges)
+        delay_between_retries = 5  # seconds
+        done = [size - sum(e - o for o, e in ranges)]
+
+        def start(c, r):
+            response = {}
+
+            def header(line):
+                line = line.decode('iso-8859-1').strip()
+                if line.startswith('HTTP/'):
+                    response['status'] = int(line.split()[1])
+
+            def write(chunk):
+                # anything but partial content means the resource changed
+                if response.get('status') != 206 or r[0] + len(chunk) > r[1]:
+                    return 0
+                os.pwrite(fd, chunk, r[0])
+                r[0] += len(chunk)
+                done[0] += len(chunk)
+                fetch_https_progress(size, done[0], 0, 0)
+
+            c.setopt(pycurl.URL, probe['url'])
+            setup_https_handle(c, list(headers or []) + ['If-Range: %s' % if_range],
+                               cookie_file, netrc, connect_timeout)
+            # segments are for parallel connections, not streams of one
+            c.setopt(pycurl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_1_1)
+            c.setopt(pycurl.PIPEWAIT, 0)
+            c.setopt(pycurl.RANGE, '%d-%d' % (r[0], r[1] - 1))
+            c.setopt(pycurl.HEADERFUNCTION, header)
+            c.setopt(pycurl.WRITEFUNCTION, write)
+            c.range = r
+            m.add_handle(c)
+
+        m = pycurl.CurlMulti()
+        handles = []
+        for r in ranges:
+            if r[0] < r[1]:
+                c = pycurl.Curl()
+                handles.append(c)
+                start(c, r)
+
+        active = len(handles)
+        # (not before time, range) of segments waiting to retry; the others keep going meanwhile
+        waiting = []
+        success = True
+        while active or waiting:
+            now = time.monotonic()
+            for not_before, r in [w for w in waiting if w[0] <= now]:
+                waiting.remove((not_before, r))
+                # a handle joins the share once, a retry takes a new one
+                c = pycurl.Curl()
+                handles.append(c)
+                start(c, r)
+                active += 1
+            if not active:
+                time.sleep(min(not_before for not_before, _r in waiting) - now)
+                continue
+
+            while True:
+                ret, active = m.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+
+            while True:
+                queued, _ok_list, err_list = m.info_read()
+                for c, _errno, errmsg in err_list:
+                    m.remove_handle(c)
+                    if retries_left and c.getinfo(pycurl.HTTP_CODE) in [0, 206]:
+                        retries_left -= 1
+                        print('curl retry %s' % errmsg)
+                        waiting.append((time.monotonic() + delay_between_retries, c.range))
+                    else:
+                        success = False
+                    handles.remove(c)
+                    c.close()
+                if not queued:
+                    break
+
+            if not success:
+                break
+            if active:
+                m.select(1.0)
+
+        for c in handles:
+            m.remove_handle(c)
+            c.close()
+        m.close()
+        end_https_progress()
+
+        if success and all(o == e for o, e in ranges):
+            return True
 
-    while retries_left > 0:
-        try:
-            with open(filename, 'wb') as f:
-                c.setopt(pycurl.WRITEFUNCTION, f.write)
-                c.perform()
+        save_part_validator(part_file, {'url': url, 'size': size, 'etag': probe['etag'],
+                                        'last_modified': probe['last_modified'],
+                                        'segments': [[o, e] for o, e in ranges if o < e]})
+        print_banner("Segmented download of %s failed" % url)
+        return False
 
-            success = True
-            break
+    finally:
+        os.close(fd)
 
-        except pycurl.error:
-            retries_left -= 1
-            print('curl retry')
-            time.sleep(delay_between_retries)
 
-    status = c.getinfo(pycurl.HTTP_CODE)
+def fetch_https_binary_file(url, filename, redirect, headers, cookie_file, netrc, connect_timeout=None) -> bool:
+    """Fetches binary file via HTTPS.  filename only appears once the transfer completes"""
+    part_file = get_part_file(filename)
+    if not fetch_https_part_file(url, part_file, redirect, headers, cookie_file, netrc, connect_timeout):
+        return False
 
-    c.close()
-    os.sync()
+    commit_part_file(part_file, filename)
+    return True
 
-    if not redirect and status == 302:
-        print_banner("Download Status: %d" % status)
+
+def extract_tar_member(tar, member, dest: str):
+    """Extracts a single tarfile member, rejecting unsafe paths where supported"""
+    import tarfile
+
+    if hasattr(tarfile, 'data_filter'):
+        tar.extract(member, dest, filter='data')
+    else:
+        tar.extract(member, dest)
+
+
+def extract_tarball(archive: str, dest: str, member_filter=None):
+    """Extracts archive to dest.  member_filter(name) selects the members to extract"""
+    import subprocess
+    import tarfile
+
+    make_sure_path_exists(dest)
+
+    if member_filter is None:
+        subprocess.check_call(['tar', '-xzf', archive, '-C', dest])
+        return
+
+    with tarfile.open(archive, mode='r|gz') as tar:
+        for member in tar:
+            if member_filter(member.name):
+                extract_tar_member(tar, member, dest)
+
+
+def fetch_https_tarball_members(url, filename, dest, member_filter, redirect, connect_timeout=None) -> bool:
+    """Streams a .tar.gz via HTTPS.  While the transfer is in flight the archive is
+    written to filename, hashed into filename.sha256, and the members selected by
+    member_filter(name) are extracted to dest.  Returns False on failure, leaving
+    no partial archive behind"""
+    import hashlib
+    import pycurl
+    import tarfile
+
+    make_sure_path_exists(dest)
+
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def extract():
+        reader = os.fdopen(read_fd, 'rb')
+        try:
+            with tarfile.open(fileobj=reader, mode='r|gz') as tar:
+                for member in tar:
+                    if member_filter(member.name):
+                        extract_tar_member(tar, member, dest)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            # drain so the transfer never blocks on a full pipe
+            while reader.read(1024 * kb):
+                pass
+            reader.close()
+
+    extractor = threading.Thread(target=extract)
+    extractor.start()
+
+    sha256_hash = hashlib.sha256()
+    writer = os.fdopen(write_fd, 'wb')
+
+    def write(chunk):
+        sha256_hash.update(chunk)
+        f.write(chunk)
+        writer.write(chunk)
+
+    c = pycurl.Curl()
+    c.setopt(pycurl.URL, url)
+    if connect_timeout is not None:
+        c.setopt(pycurl.CONNECTTIMEOUT, connect_timeout)
+    c.setopt(pycurl.NOSIGNAL, 1)
+    c.setopt(pycurl.NOPROGRESS, False)
+    c.setopt(pycurl.XFERINFOFUNCTION, fetch_https_progress)
+    if redirect:
+        c.setopt(pycurl.FOLLOWLOCATION, 1)
+        c.setopt(pycurl.AUTOREFERER, 1)
+        c.setopt(pycurl.MAXREDIRS, 255)
+
+    status = 0
+    try:
+        with open(filename, 'wb') as f:
+            c.setopt(pycurl.WRITEFUNCTION, write)
+            c.perform()
+        status = c.getinfo(pycurl.HTTP_CODE)
+    except pycurl.error as e:
+        errors.append(e)
+    finally:
+        c.close()
+        end_https_progress()
+        writer.close()
+        extractor.join()
+
+    if status != 200 or errors:
+        print_banner("Streaming %s failed (status %d) %s" % (url, status, errors))
+        if os.path.exists(filename):
+            os.remove(filename)
         return False
-    if not status == 200:
-        print_banner("Download Status: %d" % status)
-        sys.exit('Download Failed')
 
-    return success
+    sync_download(filename)
+    with open(filename + '.sha256', 'w+') as f:
+        f.write(sha256_hash.hexdigest())
+    store_cached_digests(filename, {'sha256': sha256_hash.hexdigest()})
+
+    return True
+
+
+def get_zip_member_path(dest: str, name: str) -> str:
+    """Returns extraction path of zip member name, rejecting absolute and parent paths"""
+    parts = name.replace('\\', '/').split('/')
+    if name.startswith('/') or '..' in parts:
+        raise ValueError('unsafe zip member %s' % name)
+    return os.path.join(dest, *[part for part in parts if part])
+
+
+def extract_zip_file(file, dest: str) -> list:
+    """Extracts zip archive file, a path or seekable file object, to dest.  Returns
+    the extracted files.  Raises ValueError on unsafe member paths"""
+    import shutil
+    import zipfile
+
+    files = []
+    with zipfile.ZipFile(file, 'r') as zip_ref:
+        for info in zip_ref.infolist():
+            path = get_zip_member_path(dest, info.filename)
+            if info.is_dir():
+                make_sure_path_exists(path)
+                continue
+            make_sure_path_exists(os.path.dirname(path))
+            # zipfile checks the crc as the member is read
+            with zip_ref.open(info) as src, open(path, 'wb') as out:
+                shutil.copyfileobj(src, out, 1024 * kb)
+            files.append(path)
+    return files
+
+
+def fetch_https_zip_members(url, headers, dest, tee_file=None, redirect=True, connect_timeout=None):
+    """Fetches a zip archive via HTTPS and extracts it to dest.  The archive is
+    written to tee_file if given, otherwise to a spool file that is kept in memory
+    up to 64 MiB and dropped after extraction.  Returns list of extracted files, or
+    None on failure"""
+    import pycurl
+    import tempfile
+    import zipfile
+
+    make_sure_path_exists(dest)
+
+    if tee_file:
+        spool = open(tee_file, 'w+b')
+    else:
+        spool = tempfile.SpooledTemporaryFile(max_size=64 * 1024 * kb)
+
+    c = pycurl.Curl()
+    c.setopt(pycurl.URL, url)
+    setup_https_handle(c, headers, None, None, connect_timeout)
+    c.setopt(pycurl.NOPROGRESS, False)
+    c.setopt(pycurl.XFERINFOFUNCTION, fetch_https_progress)
+    c.setopt(pycurl.WRITEFUNCTION, spool.write)
+    if redirect:
+        c.setopt(pycurl.FOLLOWLOCATION, 1)
+        c.setopt(pycurl.AUTOREFERER, 1)
+        c.setopt(pycurl.MAXREDIRS, 255)
+
+    status = 0
+    files = None
+    error = None
+    try:
+        c.perform()
+        status = c.getinfo(pycurl.HTTP_CODE)
+        if status == 200:
+            spool.seek(0)
+            files = extract_zip_file(spool, dest)
+    except (pycurl.error, zipfile.BadZipFile, ValueError, OSError) as e:
+        error = e
+    finally:
+        c.close()
+        end_https_progress()
+        spool.close()
+
+    if files is None:
+        print_banner("Fetching %s failed (status %d) %s" % (url, status, error or ''))
+        if tee_file and os.path.exists(tee_file):
+            os.remove(tee_file)
+        return None
+
+    return files
 
 
 def test_internet_connection() -> bool:
@@ -40,13 +40,41 @@ import time
 import zipfile
 from platform import system
 
+from common import cache_writes
 from common import check_python_version
+from common import clone_tree
 from common import compare_sha256
+from common import apply_download_settings
+from common import configure_artifact_store
+from common import configure_download_durability
+from common import configure_progress
 from common import download_https_file
+from common import download_https_files
+from common import extract_tarball
+from common import extract_zip_file
 from common import fetch_https_binary_file
+from common import fetch_https_tarball_members
+from common import fetch_https_zip_members
+from common import find_artifact
+from common import file_lock
+from common import get_cache_folder
+from common import get_cached_digests
+from common import get_download_settings
+from common import get_file_stamps
+from common import get_folder_size
+from common import get_sha256sum
 from common import handle_ctrl_c
+from common import is_artifact_store_enabled
+from common import is_file_stamps_current
+from common import load_json_file
+from common import kb
 from common import make_sure_path_exists
+from common import note_cache_write
 from common import print_banner
+from common import restore_artifact
+from common import save_digest_cache
+from common import store_artifact
+from common import write_sha256_file
 
 from create_aot import get_flutter_sdk_version
 from create_aot import create_platform_aot
@@ -71,6 +99,8 @@ def main():
                         help='Set cookie-file to use.  Overrides _globals.json key/value')
     parser.add_argument('--fetch-engine', default=False,
                         action='store_true', help='Fetch Engine artifacts')
+    parser.add_argument('--engine-sdk-full', default=False, action='store_true',
+                        help='Extract the complete engine-sdk, not only the files used by the workspace')
     parser.add_argument('--find-working-commit', default=False, action='store_true',
                         help='Use to finding GIT commit where flutter analyze returns true')
     parser.add_argument('--plex', default='', type=str,
@@ -86,7 +116,8 @@ def main():
     parser.add_argument('--plugin-platform', default='linux', type=str, help='specify plugin platform type')
     parser.add_argument('--create-aot', default=False, action='store_true', help='Generate AOT')
     parser.add_argument('--app-path', default='', type=str, help='Specify Application path')
-    parser.add_argument('--arch', default=get_flutter_arch(), type=str, help='specify flutter architecture')
+    parser.add_argument('--arch', default=get_flutter_arch(), type=str,
+                        help='specify flutter architecture.  Comma separated list fetches engine runtime of each')
 
     args = parser.parse_args()
 
@@ -97,7 +128,7 @@ def main():
         if args.app_path == '':
             sys.exit("Must specify value for --app-path")
 
-        set_gen_snapshot('release', args.arch)
+        set_gen_snapshot('release', args.arch.split(',')[0])
         create_platform_aot(args.app_path, get_flutter_sdk_version())
         return
 
@@ -169,7 +200,7 @@ def main():
     #
     if args.fetch_engine:
         print_banner("Fetching Engine Artifacts")
-        get_flutter_engine_runtime(True, args.arch)
+        get_flutter_engine_runtime(True, args.arch, extract_all=args.engine_sdk_full)
         return
 
     #
@@ -177,6 +208,9 @@ def main():
     #
     config = get_workspace_config(args.config)
     globals_ = config.get('globals')
+    configure_artifact_store(globals_.get('artifact_store', True), globals_.get('artifact_store_max_mb'))
+    configure_download_durability(globals_.get('download_durability', 'file'))
+    configure_progress(globals_.get('download_progress', 'auto'))
 
     platforms = config.get('platforms')
     for platform_ in platforms:
@@ -236,10 +270,8 @@ def main():
     if not is_exist:
         os.makedirs(app_folder)
 
-    get_workspace_repos(app_folder, config)
-
     #
-    # Get Flutter SDK
+    # Flutter SDK version
     #
     if args.flutter_version:
         flutter_version = args.flutter_version
@@ -249,20 +281,10 @@ def main():
         else:
             flutter_version = "main"
 
-    print_banner("Flutter Version: %s" % flutter_version)
-    flutter_sdk_path = get_flutter_sdk(flutter_version)
-    flutter_bin_path = os.path.join(flutter_sdk_path, 'bin')
-
-    # force tool rebuild
-    force_tool_rebuild(flutter_sdk_folder)
-
-    # Enable custom devices in dev and stable
-    if flutter_version != "main":
-        patch_flutter_sdk(flutter_sdk_folder)
-
     #
     # Configure Workspace
     #
+    flutter_bin_path = os.path.join(flutter_sdk_folder, 'bin')
 
     os.environ['PATH'] = '%s:%s' % (os.environ.get('PATH'), flutter_bin_path)
     os.environ['PUB_CACHE'] = os.path.join(os.environ.get('FLUTTER_WORKSPACE'), '.config', 'flutter_workspace',
@@ -274,35 +296,6 @@ def main():
     print("PUB_CACHE=%s" % os.environ.get('PUB_CACHE'))
     print("XDG_CONFIG_HOME=%s" % os.environ.get('XDG_CONFIG_HOME'))
 
-    #
-    # Trigger upgrade on Channel if version is all letters
-    #
-    if flutter_version.isalpha():
-        print_banner("Setting channel to `%s`" % flutter_version)
-        cmd = ['flutter', 'channel', flutter_version]
-        subprocess.check_call(cmd, cwd=flutter_sdk_path)
-        print_banner("Upgrading")
-        cmd = ['flutter', 'upgrade', '--force']
-        subprocess.check_call(cmd, cwd=flutter_sdk_path)
-
-    #
-    # Configure SDK
-    #
-    configure_flutter_sdk()
-
-    #
-    # Flutter Engine Runtime
-    #
-    get_flutter_engine_runtime(clean_workspace, args.arch)
-
-    #
-    # Create environmental setup script
-    #
-    write_env_script_header(workspace)
-
-    #
-    # Setup Platform(s)
-    #
     github_token = globals_.get('github_token')
     if args.github_token:
         github_token = args.github_token
@@ -311,7 +304,40 @@ def main():
     if args.cookie_file:
         cookie_file = args.cookie_file
 
-    setup_platforms(platforms, github_token, cookie_file, args.plex)
+    #
+    # Workspace setup graph; each step starts as soon as the steps it depends on are done
+    #
+    from functools import partial
+
+    plex = args.plex.split(" ") if args.plex else []
+    platform_jobs = int(globals_.get('platform_jobs', 1))
+
+    sdk = {}
+    tasks, slot_limits = get_workspace_repo_tasks(app_folder, config)
+    slot_limits['platforms'] = platform_jobs
+    tasks += [
+        {'id': 'flutter-sdk',
+         'fn': lambda: sdk.update(bin_cache_key=setup_flutter_sdk(flutter_version, globals_))},
+        {'id': 'flutter-configure', 'deps': ['flutter-sdk'],
+         'fn': lambda: configure_flutter_sdk_version(flutter_version, sdk.get('bin_cache_key'),
+                                                     globals_.get('flutter_bin_cache_keep', 4))},
+        # a channel upgrade moves the engine version
+        {'id': 'engine', 'deps': ['flutter-configure' if flutter_version.isalpha() else 'flutter-sdk'],
+         'fn': partial(get_flutter_engine_runtime, clean_workspace, args.arch, extract_all=args.engine_sdk_full)},
+        {'id': 'env-script',
+         'fn': partial(write_env_script_header, workspace)},
+        {'id': 'platform-artifacts',
+         'fn': partial(prefetch_platform_artifacts, platforms, github_token, cookie_file, plex)},
+    ]
+    # each platform also waits on the repos it references only
+    tasks += get_platform_tasks(platforms, config.get('repos') or [], github_token, cookie_file, plex,
+                                platform_jobs > 1, globals_.get('step_ledger', True) is not False,
+                                ['flutter-configure', 'engine', 'env-script', 'platform-artifacts'])
+
+    wall_times, failed = run_workspace_setup(tasks, int(globals_.get('setup_jobs', len(tasks))), slot_limits)
+    finish_workspace_repos(config, wall_times, failed)
+    if failed:
+        sys.exit("Workspace setup failed: %s" % ', '.join(failed))
 
     #
     # Display the custom devices list
@@ -329,16 +355,56 @@ def main():
     flutter_workspace = os.environ.get('FLUTTER_WORKSPACE')
     subprocess.check_call(cmd, cwd=flutter_workspace)
 
+    # git mirrors, snapshots and artifacts a run as root wrote
+    save_digest_cache()
+    chown_cache_entries(user[0])
+
     #
     # Done
     #
     print_banner("Setup Flutter Workspace - Complete")
 
 
+def chown_cache_entries(user):
+    """ Gives user the root owned cache entries this run wrote, and the folders
+    above them.  The rest of the cache, possibly shared with other users, is
+    not visited """
+    import pwd
+
+    if os.geteuid() != 0:
+        return
+
+    pw = pwd.getpwnam(user)
+    cache_folder = os.path.abspath(get_cache_folder())
+    paths = set()
+    for path in cache_writes:
+        path = os.path.abspath(path)
+        if os.path.commonpath([cache_folder, path]) != cache_folder:
+            continue
+        paths.add(path)
+        parent = path
+        while parent != cache_folder:
+            parent = os.path.dirname(parent)
+            paths.add(parent)
+        # a mirror or snapshot is written throughout
+        if os.path.isdir(path) and not os.path.islink(path):
+            for root, dirs, files in os.walk(path):
+                paths.update(os.path.join(root, name) for name in dirs + files)
+
+    for path in paths:
+        try:
+            if os.lstat(path).st_uid == 0:
+                os.lchown(path, pw.pw_uid, pw.pw_gid)
+        except FileNotFoundError:
+            continue
+
+
 def clear_folder(dir_):
-    """ Clears folder specified """
+    """ Clears folder specified.  Symlinks are removed, not followed """
     import shutil
-    if os.path.exists(dir_):
+    if os.path.islink(dir_):
+        os.unlink(dir_)
+    elif os.path.exists(dir_):
         shutil.rmtree(dir_)
 
 
@@ -376,6 +442,7 @@ def get_workspace_config(path):
                         if 'load' in platform_:
                             if not platform_['load']:
                                 continue
+                        platform_.setdefault('config_file', tail)
                         data['platforms'].append(platform_)
                     except json.decoder.JSONDecodeError:
                         print("Invalid JSON in %s" % f)
@@ -541,8 +608,314 @@ def validate_custom_device_config(config):
     return True
 
 
-def get_repo(base_folder, uri, branch, rev):
-    """ Clone Git Repo """
+def get_repo_name(uri):
+    """ Returns folder name of repo uri """
+    repo_name = uri.rsplit('/', 1)[-1]
+    repo_name = repo_name.split(".")
+    return repo_name[0]
+
+
+def get_git_mirror_cache_folder(globals_):
+    """ Returns host wide git mirror folder, None if disabled in globals """
+    if globals_ and globals_.get('git_mirror_cache') is False:
+        return None
+
+    cache_folder = os.path.join(get_cache_folder(), 'git')
+    make_sure_path_exists(cache_folder)
+    return cache_folder
+
+
+def get_git_mirror_path(cache_folder, uri):
+    """ Returns bare mirror path of uri.  Keyed by uri to avoid name clashes """
+    import hashlib
+    key = hashlib.sha1(uri.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(cache_folder, '%s-%s.git' % (get_repo_name(uri), key))
+
+
+def update_git_mirror(cache_folder, uri):
+    """ Create or fetch deltas into bare mirror of uri.  Caller holds mirror lock """
+    mirror = get_git_mirror_path(cache_folder, uri)
+
+    if os.path.exists(os.path.join(mirror, 'HEAD')):
+        print('Updating mirror %s' % mirror)
+        cmd = ['git', 'fetch', '--prune', '--tags', 'origin']
+        subprocess.check_call(cmd, cwd=mirror)
+    else:
+        clear_folder(mirror)
+        cmd = ['git', 'clone', '--bare', uri, mirror]
+        subprocess.check_call(cmd)
+        # track branches and tags only; skips refs/pull/* and friends
+        cmd = ['git', 'config', 'remote.origin.fetch', '+refs/heads/*:refs/heads/*']
+        subprocess.check_call(cmd, cwd=mirror)
+
+    # mark as recently used for LRU eviction
+    os.utime(mirror)
+    note_cache_write(mirror)
+    return mirror
+
+
+def has_git_worktrees(mirror) -> bool:
+    """ True if worktrees are registered with mirror.  Their .git files point into
+    the mirror, so evicting it would break them """
+    worktrees = os.path.join(mirror, 'worktrees')
+    if not os.path.isdir(worktrees):
+        return False
+    # forget worktrees of removed workspaces
+    get_git_output(['git', 'worktree', 'prune'], mirror)
+    return os.path.isdir(worktrees) and bool(os.listdir(worktrees))
+
+
+def prune_git_mirror_cache(cache_folder, max_size_mb, in_use):
+    """ Evicts least recently used mirrors until cache is below max_size_mb.
+    Mirrors with worktrees are kept """
+    import glob
+
+    if not max_size_mb:
+        return
+
+    mirrors = []
+    total = 0
+    for mirror in glob.glob(os.path.join(cache_folder, '*.git')):
+        size = get_folder_size(mirror)
+        mirrors.append((os.stat(mirror).st_mtime, size, mirror))
+        total += size
+
+    max_size = int(max_size_mb) * kb * kb
+    for _last_used, size, mirror in sorted(mirrors):
+        if total <= max_size:
+            break
+        if mirror in in_use:
+            continue
+        try:
+            with file_lock(mirror + '.lock', blocking=False):
+                if has_git_worktrees(mirror):
+                    continue
+                print('Evicting mirror %s' % mirror)
+                clear_folder(mirror)
+        except BlockingIOError:
+            continue
+        total -= size
+
+
+def get_git_output(cmd, cwd):
+    """ Returns stripped stdout of git command, empty string on failure """
+    result = subprocess.run(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            universal_newlines=True)
+    if result.returncode:
+        return ''
+    return result.stdout.strip()
+
+
+def get_git_head(git_folder):
+    return get_git_output(['git', 'rev-parse', 'HEAD'], git_folder)
+
+
+def get_git_stamp_file(git_folder, name):
+    git_dir = get_git_output(['git', 'rev-parse', '--absolute-git-dir'], git_folder)
+    return os.path.join(git_dir, 'flutter_workspace_%s' % name) if git_dir else None
+
+
+def read_git_stamp(git_folder, name):
+    """ Returns value of a stamp kept in the git dir of git_folder, None if missing """
+    stamp_file = get_git_stamp_file(git_folder, name)
+    try:
+        with open(stamp_file, 'r') as f:
+            return f.read().strip()
+    except (TypeError, FileNotFoundError):
+        return None
+
+
+def write_git_stamp(git_folder, name, value):
+    with open(get_git_stamp_file(git_folder, name), 'w') as f:
+        f.write(value)
+
+
+def get_git_checkout(git_folder):
+    """ Returns HEAD of git_folder and the id of its last checkout by the workspace,
+    which changes when a checkout discarded local changes """
+    return '%s %s' % (get_git_head(git_folder), read_git_stamp(git_folder, 'checkout') or '')
+
+
+def get_git_tree_digest(git_folder):
+    """ Returns sha256 of the changes to tracked files of git_folder, submodules aside """
+    import hashlib
+    result = subprocess.run(['git', 'diff', 'HEAD', '--binary', '--ignore-submodules'], cwd=git_folder,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return hashlib.sha256(result.stdout).hexdigest()
+
+
+def record_git_tree(cwd):
+    """ Records the changes post_cmds left in the app repo containing cwd, such as
+    applied patches, so the next sync keeps them """
+    app_folder = os.path.join(os.environ.get('FLUTTER_WORKSPACE'), 'app')
+    top = get_git_output(['git', 'rev-parse', '--show-toplevel'], cwd)
+    if top and os.path.dirname(os.path.realpath(top)) == os.path.realpath(app_folder):
+        write_git_stamp(top, 'tree', get_git_tree_digest(top))
+
+
+def get_git_commit(git_folder, rev):
+    """ Returns commit sha of rev if present in the local object store """
+    return get_git_output(['git', 'rev-parse', '-q', '--verify', '%s^{commit}' % rev], git_folder)
+
+
+def is_git_submodules_current(git_folder):
+    """ True if every submodule is initialized and checked out at its pinned sha """
+    status = get_git_output(['git', 'submodule', 'status', '--recursive'], git_folder)
+    for line in status.splitlines():
+        if line[:1] in ('-', '+', 'U'):
+            return False
+    return True
+
+
+clone_profiles = {
+    'full': {},
+    'shallow': {'depth': 1},
+    'partial': {'filter': 'blob:none'},
+    'sparse': {'filter': 'blob:none', 'sparse': True},
+}
+
+
+def get_clone_profile(globals_, repo):
+    """ Returns clone profile of repo entry.  Falls back to globals clone_profile """
+    profiles = dict(clone_profiles)
+    profiles.update(globals_.get('clone_profiles') or {})
+
+    profile = repo.get('clone_profile', globals_.get('clone_profile', 'full'))
+    if not isinstance(profile, dict):
+        if profile not in profiles:
+            sys.exit("Unknown clone_profile: %s" % profile)
+        profile = profiles[profile]
+
+    profile = dict(profile)
+    profile['sparse'] = get_sparse_paths(repo, profile.get('sparse'))
+    return profile
+
+
+def get_sparse_paths(repo, sparse):
+    """ Returns sparse-checkout path list.  True selects the repo relative pubspec_path """
+    if not sparse:
+        return []
+    if isinstance(sparse, list):
+        return sparse
+
+    pubspec_path = repo.get('pubspec_path')
+    if not pubspec_path:
+        return []
+
+    # pubspec_path is relative to app folder, first component is the repo folder
+    parts = pubspec_path.strip('/').split('/', 1)
+    if len(parts) < 2:
+        return []
+    return [parts[1]]
+
+
+def get_profile_fetch_args(profile):
+    """ Returns git fetch/clone arguments of clone profile """
+    args = []
+    if profile.get('depth'):
+        args += ['--depth', str(profile['depth'])]
+    if profile.get('filter'):
+        args += ['--filter=%s' % profile['filter']]
+    return args
+
+
+def clone_repo(base_folder, uri, branch, rev, mirror_cache, profile):
+    """ Clone uri into base_folder, via local clone of the mirror if enabled """
+    repo_name = get_repo_name(uri)
+    git_folder = os.path.join(base_folder, repo_name)
+
+    sparse = profile.get('sparse')
+    sparse_args = ['--sparse'] if sparse else []
+
+    if mirror_cache:
+        # a local clone hardlinks objects, so evicting the mirror later
+        # never breaks the workspace checkout
+        mirror = get_git_mirror_path(mirror_cache, uri)
+        with file_lock(mirror + '.lock'):
+            update_git_mirror(mirror_cache, uri)
+            cmd = ['git', 'clone', '--local'] + sparse_args + [mirror, '-b', branch, repo_name]
+            subprocess.check_call(cmd, cwd=base_folder)
+
+        cmd = ['git', 'remote', 'set-url', 'origin', uri]
+        subprocess.check_call(cmd, cwd=git_folder)
+
+    elif rev and profile.get('depth'):
+        # fetch the pinned rev by sha instead of the branch tip
+        make_sure_path_exists(git_folder)
+        subprocess.check_call(['git', 'init', '-q'], cwd=git_folder)
+        subprocess.check_call(['git', 'remote', 'add', 'origin', uri], cwd=git_folder)
+        cmd = ['git', 'fetch', '--no-tags'] + get_profile_fetch_args(profile) + ['origin', rev]
+        subprocess.check_call(cmd, cwd=git_folder)
+        if sparse:
+            subprocess.check_call(['git', 'sparse-checkout', 'set'] + sparse, cwd=git_folder)
+        subprocess.check_call(['git', 'checkout', 'FETCH_HEAD'], cwd=git_folder)
+        return
+
+    else:
+        cmd = ['git', 'clone'] + get_profile_fetch_args(profile) + sparse_args + [uri, '-b', branch, repo_name]
+        subprocess.check_call(cmd, cwd=base_folder)
+
+    if sparse:
+        subprocess.check_call(['git', 'sparse-checkout', 'set'] + sparse, cwd=git_folder)
+
+    if rev:
+        cmd = ['git', 'checkout', rev]
+        subprocess.check_call(cmd, cwd=git_folder)
+
+
+def fetch_repo(git_folder, uri, branch, mirror_cache, profile):
+    """ Fetch branch and tags of an existing checkout, via the mirror if enabled """
+    if mirror_cache:
+        mirror = get_git_mirror_path(mirror_cache, uri)
+        with file_lock(mirror + '.lock'):
+            update_git_mirror(mirror_cache, uri)
+            cmd = ['git', 'fetch', '--tags', mirror, '+refs/heads/*:refs/remotes/origin/*']
+            subprocess.check_call(cmd, cwd=git_folder)
+    else:
+        # shallow profiles skip tags, fetching every tag would pull in its history
+        tags = '--no-tags' if profile.get('depth') else '--tags'
+        cmd = ['git', 'fetch', tags] + get_profile_fetch_args(profile) + [
+            'origin', '+refs/heads/%s:refs/remotes/origin/%s' % (branch, branch)]
+        subprocess.check_call(cmd, cwd=git_folder)
+
+
+def sync_repo(git_folder, uri, branch, rev, mirror_cache, profile) -> bool:
+    """ Incrementally update an existing checkout to branch head or rev.  Changes
+    to tracked files are discarded unless they are those post_cmds left, see
+    record_git_tree.  Untracked files such as build folders are kept.  Returns True
+    if it checked out """
+    if rev:
+        target = get_git_commit(git_folder, rev)
+        if not target and not profile.get('depth'):
+            fetch_repo(git_folder, uri, branch, mirror_cache, profile)
+            target = get_git_commit(git_folder, rev)
+        if not target:
+            # rev not reachable from branch or tags, fetch by sha
+            cmd = ['git', 'fetch', '--no-tags'] + get_profile_fetch_args(profile) + ['origin', rev]
+            subprocess.check_call(cmd, cwd=git_folder)
+            target = get_git_commit(git_folder, 'FETCH_HEAD')
+    else:
+        fetch_repo(git_folder, uri, branch, mirror_cache, profile)
+        target = get_git_commit(git_folder, 'refs/remotes/origin/%s' % branch)
+
+    # submodules are checked by the submodule follow up
+    dirty = get_git_output(['git', 'status', '--porcelain', '--untracked-files=no', '--ignore-submodules'],
+                           git_folder)
+    if target == get_git_head(git_folder) and (
+            not dirty or get_git_tree_digest(git_folder) == read_git_stamp(git_folder, 'tree')):
+        print('%s is up to date' % git_folder)
+        return False
+
+    if rev:
+        cmd = ['git', 'checkout', '--force', target]
+    else:
+        cmd = ['git', 'checkout', '--force', '-B', branch, target]
+    subprocess.check_call(cmd, cwd=git_folder)
+    return True
+
+
+def get_repo(base_folder, uri, branch, rev, mirror_cache=None, profile=None):
+    """ Clone or incrementally sync Git Repo.  Returns (lfs, submodules) follow up work needed """
     if not uri:
         print("repo entry needs a 'uri' key.  Skipping")
         return
@@ -550,60 +923,277 @@ def get_repo(base_folder, uri, branch, rev):
         print("repo entry needs a 'branch' key.  Skipping")
         return
 
+    if profile is None:
+        profile = {}
+
     # get repo folder name
-    repo_name = uri.rsplit('/', 1)[-1]
-    repo_name = repo_name.split(".")
-    repo_name = repo_name[0]
+    repo_name = get_repo_name(uri)
 
     git_folder = os.path.join(base_folder, repo_name)
 
-    is_exist = os.path.exists(git_folder)
-    if is_exist:
-        cmd = ['rm', '-rf', git_folder]
+    if is_repo(git_folder) and get_git_output(['git', 'remote', 'get-url', 'origin'], git_folder) == uri:
+        checked_out = sync_repo(git_folder, uri, branch, rev, mirror_cache, profile)
+    else:
+        clear_folder(git_folder)
+        clone_repo(base_folder, uri, branch, rev, mirror_cache, profile)
+        checked_out = True
 
-    cmd = ['git', 'clone', uri, '-b', branch, repo_name]
-    subprocess.check_call(cmd, cwd=base_folder)
+    if checked_out:
+        # platform steps fingerprint the checkout, so patches they applied are reapplied
+        import uuid
+        write_git_stamp(git_folder, 'checkout', uuid.uuid4().hex)
 
-    if rev:
-        cmd = ['git', 'checkout', rev]
-        subprocess.check_call(cmd, cwd=git_folder)
+    # the lfs stamp is written once the fetch succeeded, a failed run retries it
+    git_lfs_file = os.path.join(git_folder, '.gitattributes')
+    needs_lfs = os.path.exists(git_lfs_file) and read_git_stamp(git_folder, 'lfs') != get_git_head(git_folder)
 
-    # get lfs
-    git_lfs_file = os.path.join(base_folder, repo_name, '.gitattributes')
-    if os.path.exists(git_lfs_file):
-        cmd = ['git', 'lfs', 'fetch', '--all']
-        subprocess.check_call(cmd, cwd=git_folder)
+    git_submodule_file = os.path.join(git_folder, '.gitmodules')
+    needs_submodules = os.path.exists(git_submodule_file) and (
+        checked_out or not is_git_submodules_current(git_folder))
 
-    # get all submodules
-    git_submodule_file = os.path.join(base_folder, repo_name, '.gitmodules')
-    if os.path.exists(git_submodule_file):
-        cmd = ['git', 'submodule', 'update', '--init', '--recursive']
-        subprocess.check_call(cmd, cwd=git_folder)
+    return needs_lfs, needs_submodules
+
+
+def get_repo_lfs(git_folder):
+    """ Fetch all git lfs objects of checkout """
+    cmd = ['git', 'lfs', 'fetch', '--all']
+    subprocess.check_call(cmd, cwd=git_folder)
+    write_git_stamp(git_folder, 'lfs', get_git_head(git_folder))
 
 
-def get_workspace_repos(base_folder, config):
-    """ Clone GIT repos referenced in config repos dict to base_folder """
+def get_repo_submodules(git_folder, profile):
+    """ Init and update all submodules of checkout """
+    cmd = ['git', 'submodule', 'update', '--init', '--recursive']
+    if profile.get('depth'):
+        cmd.append('--depth=%s' % profile['depth'])
+    subprocess.check_call(cmd, cwd=git_folder)
+
+
+def get_uri_host(uri):
+    """ Returns host name of git uri, including scp like user@host:path """
+    from urllib.parse import urlparse
+
+    host = urlparse(uri).hostname
+    if host:
+        return host
+    if '@' in uri and ':' in uri:
+        return uri.split('@', 1)[1].split(':', 1)[0]
+    return 'localhost'
+
+
+def run_scheduled_tasks(tasks, max_jobs, slot_limits):
+    """ Runs tasks on a bounded pool, highest priority first.  A task is a dict
+    of id, fn, slot, priority and deps.  A task starts once every task id in deps
+    has completed, including follow ups, and fails if one of them failed.  slot
+    is a name or a list of names; at most slot_limits[slot] (or 'default') tasks
+    of a slot run at once.  fn may
+    return follow up tasks which are queued when it completes.  Returns (wall
+    time per task id, failed task ids).  Raises ValueError for a limit below 1
+    and RuntimeError if tasks wait on ids that never run """
     import concurrent.futures
 
-    if 'repos' not in config:
-        return
+    for limit in [max_jobs] + list(slot_limits.values()):
+        if int(limit) < 1:
+            raise ValueError("Invalid job limit %s" % limit)
+
+    pending = list(tasks)
+    running = {}
+    slot_running = {}
+    started = {}
+    finished = {}
+    failed = []
+
+    def is_outstanding(id_):
+        return any(t['id'] == id_ for t in pending) or any(t['id'] == id_ for t in running.values())
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_jobs) as executor:
+        while pending or running:
+            pending.sort(key=lambda t: t.get('priority', 0), reverse=True)
+            for task in list(pending):
+                deps = task.get('deps', [])
+                failed_deps = [d for d in deps if d in failed]
+                if failed_deps:
+                    pending.remove(task)
+                    print_banner("Skipped %s: %s failed" % (task['id'], ', '.join(failed_deps)))
+                    failed.append(task['id'])
+                    continue
+                if any(d not in finished or is_outstanding(d) for d in deps):
+                    continue
 
-    repos = config['repos']
+                if len(running) >= max_jobs:
+                    break
+                slots = get_task_slots(task)
+                if any(slot_running.get(slot, 0) >= slot_limits.get(slot, slot_limits.get('default', max_jobs))
+                       for slot in slots):
+                    continue
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = []
-        for repo in repos:
-            futures.append(executor.submit(get_repo, base_folder=base_folder, uri=repo.get(
-                'uri'), branch=repo.get('branch'), rev=repo.get('rev')))
-            subprocess.check_call(['sudo', '-v'], stdout=subprocess.DEVNULL)
+                pending.remove(task)
+                for slot in slots:
+                    slot_running[slot] = slot_running.get(slot, 0) + 1
+                started.setdefault(task['id'], time.monotonic())
+                running[executor.submit(task['fn'])] = task
+
+            if not running:
+                # nothing can start; remaining tasks wait on ids that never run
+                raise RuntimeError("Unresolved dependencies of %s" % ', '.join(t['id'] for t in pending))
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                for slot in get_task_slots(task):
+                    slot_running[slot] -= 1
+                finished[task['id']] = time.monotonic()
+                try:
+                    follow_ups = future.result()
+                except (Exception, SystemExit) as e:
+                    print_banner("Failed %s: %s" % (task['id'], e))
+                    failed.append(task['id'])
+                    continue
+                if follow_ups:
+                    pending.extend(follow_ups)
 
-        for _future in concurrent.futures.as_completed(futures):
+            # reset sudo timeout
             subprocess.check_call(['sudo', '-v'], stdout=subprocess.DEVNULL)
 
-    print_banner("Repos Cloned")
+    wall_times = {}
+    for id_, start in started.items():
+        wall_times[id_] = finished[id_] - start
 
-    # reset sudo timeout
-    subprocess.check_call(['sudo', '-v'], stdout=subprocess.DEVNULL)
+    return wall_times, failed
+
+
+def get_task_slots(task) -> list:
+    slot = task.get('slot')
+    return slot if isinstance(slot, list) else [slot]
+
+
+def run_workspace_setup(tasks, max_jobs, slot_limits):
+    """ Runs workspace setup graph and prints the wall time of each step.
+    Returns (wall time per task id, failed task ids) """
+    wall_times, failed = run_scheduled_tasks(tasks, max_jobs, slot_limits)
+
+    print_banner("Workspace Setup")
+    for id_, wall_time in sorted(wall_times.items(), key=lambda item: item[1], reverse=True):
+        print('%8.1fs %s%s' % (wall_time, id_, ' (failed)' if id_ in failed else ''))
+
+    return wall_times, failed
+
+
+def sync_repo_task(base_folder, repo, mirror_cache, profile, priority):
+    """ Clone/sync task of a repo.  Returns lfs and submodule follow up tasks """
+    from functools import partial
+
+    uri = repo.get('uri')
+    needs = get_repo(base_folder, uri, repo.get('branch'), repo.get('rev'), mirror_cache, profile)
+    if not needs:
+        return []
+
+    needs_lfs, needs_submodules = needs
+    git_folder = os.path.join(base_folder, get_repo_name(uri))
+
+    steps = []
+    if needs_lfs:
+        steps.append(partial(get_repo_lfs, git_folder))
+    if needs_submodules:
+        steps.append(partial(get_repo_submodules, git_folder, profile))
+    if not steps:
+        return []
+
+    # both write the index of the repo, so they run one after the other
+    return [{'id': uri, 'slot': get_repo_slots(uri), 'priority': priority, 'fn': partial(run_steps, steps)}]
+
+
+def run_steps(steps):
+    for step in steps:
+        step()
+
+
+def get_repo_sync_times_file():
+    return os.path.join(get_cache_folder(), 'repo_sync_times.json')
+
+
+def load_repo_sync_times():
+    """ Returns wall time of previous syncs keyed by uri """
+    return load_json_file(get_repo_sync_times_file())
+
+
+def save_repo_sync_times(times):
+    sync_times_file = get_repo_sync_times_file()
+    tmp_file = '%s.%d' % (sync_times_file, os.getpid())
+    with open(tmp_file, 'w+') as f:
+        json.dump(times, f, indent=2)
+    os.replace(tmp_file, sync_times_file)
+    note_cache_write(sync_times_file)
+
+
+def get_repo_slots(uri) -> list:
+    """ Scheduler slots of a repo sync, bounded by repo_sync_jobs and repo_sync_host_jobs """
+    return ['repos', 'host:' + get_uri_host(uri or '')]
+
+
+def get_repo_mirror_cache(mirror_cache, repo, profile):
+    """ Returns mirror cache folder used by repo, None if it clones without one """
+    # shallow and partial profiles trim the transfer themselves, a full mirror would defeat that
+    if not repo.get('mirror', True) or profile.get('depth') or profile.get('filter'):
+        return None
+    return mirror_cache
+
+
+def get_workspace_repo_tasks(base_folder, config) -> tuple:
+    """ Returns (tasks, slot limits) cloning GIT repos referenced in config repos
+    dict to base_folder.  Each task id is the repo uri """
+    from functools import partial
+
+    repos = config.get('repos') or []
+
+    globals_ = config.get('globals') or {}
+    mirror_cache = get_git_mirror_cache_folder(globals_)
+
+    host_jobs = globals_.get('repo_sync_host_jobs', 4)
+    if not isinstance(host_jobs, dict):
+        host_jobs = {'default': host_jobs}
+    slot_limits = {'repos': int(globals_.get('repo_sync_jobs', min(32, (os.cpu_count() or 1) + 4)))}
+
+    # longest job first, using wall time of the previous sync.  Unknown repos go first
+    sync_times = load_repo_sync_times()
+
+    tasks = []
+    for repo in repos:
+        uri = repo.get('uri')
+        profile = get_clone_profile(globals_, repo)
+        host = get_uri_host(uri or '')
+        slot_limits['host:' + host] = int(host_jobs.get(host, host_jobs.get('default', 4)))
+
+        priority = sync_times.get(uri, float('inf'))
+        tasks.append({'id': uri, 'slot': get_repo_slots(uri), 'priority': priority,
+                      'fn': partial(sync_repo_task, base_folder, repo,
+                                    get_repo_mirror_cache(mirror_cache, repo, profile), profile, priority)})
+
+    return tasks, slot_limits
+
+
+def finish_workspace_repos(config, wall_times, failed):
+    """ Saves the sync times of the repos, prunes the git mirror cache and creates
+    the vscode launch file """
+    if 'repos' not in config:
+        return
+
+    repos = config['repos']
+    globals_ = config.get('globals') or {}
+    mirror_cache = get_git_mirror_cache_folder(globals_)
+
+    sync_times = load_repo_sync_times()
+    mirrors_in_use = []
+    for repo in repos:
+        uri = repo.get('uri')
+        if uri in wall_times and uri not in failed:
+            sync_times[uri] = round(wall_times[uri], 1)
+        if uri and get_repo_mirror_cache(mirror_cache, repo, get_clone_profile(globals_, repo)):
+            mirrors_in_use.append(get_git_mirror_path(mirror_cache, uri))
+    save_repo_sync_times(sync_times)
+
+    if mirror_cache:
+        prune_git_mirror_cache(mirror_cache, globals_.get('git_mirror_cache_max_mb'), mirrors_in_use)
 
     #
     # Create vscode startup tasks
@@ -882,21 +1472,68 @@ def handle_custom_devices(platform_):
     if "custom-device" not in platform_:
         return
 
-    custom_devices = get_flutter_custom_devices()
+    # platforms set up in parallel update the same file
+    with file_lock(get_flutter_custom_config_path() + '.lock'):
+        custom_devices = get_flutter_custom_devices()
 
-    overwrite_existing = platform_.get('overwrite-existing')
+        overwrite_existing = platform_.get('overwrite-existing')
 
-    # check if id already exists, remove if overwrite enabled, otherwise skip
-    if custom_devices:
-        for custom_device in custom_devices:
-            if 'id' in custom_device:
-                id_ = custom_device['id']
-                if overwrite_existing and (id_ == platform_['id']):
-                    # print("attempting to remove custom-device: %s" % id_)
-                    remove_flutter_custom_devices_id(id_)
+        # check if id already exists, remove if overwrite enabled, otherwise skip
+        if custom_devices:
+            for custom_device in custom_devices:
+                if 'id' in custom_device:
+                    id_ = custom_device['id']
+                    if overwrite_existing and (id_ == platform_['id']):
+                        # print("attempting to remove custom-device: %s" % id_)
+                        remove_flutter_custom_devices_id(id_)
 
-    add_flutter_custom_device_ex(
-        platform_['custom-device'], platform_['flutter_runtime'])
+        add_flutter_custom_device_ex(
+            platform_['custom-device'], platform_['flutter_runtime'])
+
+
+def setup_flutter_sdk(flutter_version, globals_):
+    """ Checks out and patches Flutter SDK, restoring a bin/cache snapshot if one
+    matches.  Returns the bin/cache key, None for channels """
+    workspace = os.environ.get('FLUTTER_WORKSPACE')
+    flutter_sdk_folder = os.path.join(workspace, 'flutter')
+
+    print_banner("Flutter Version: %s" % flutter_version)
+    get_flutter_sdk(flutter_version, globals_.get('flutter_sdk_cache', True))
+
+    # Enable custom devices in dev and stable
+    if flutter_version != "main":
+        patch_flutter_sdk(flutter_sdk_folder)
+
+    # channels move on upgrade, only pinned versions use the bin/cache snapshots
+    bin_cache_key = None
+    if not flutter_version.isalpha() and globals_.get('flutter_bin_cache', True):
+        bin_cache_key = get_flutter_bin_cache_key(flutter_sdk_folder)
+
+    # force tool rebuild, unless bin/cache matches a snapshot with the tool already built
+    if not restore_flutter_bin_cache(flutter_sdk_folder, bin_cache_key):
+        force_tool_rebuild(flutter_sdk_folder)
+
+    return bin_cache_key
+
+
+def configure_flutter_sdk_version(flutter_version, bin_cache_key, bin_cache_keep):
+    """ Upgrades channels, configures Flutter SDK and saves its bin/cache snapshot """
+    workspace = os.environ.get('FLUTTER_WORKSPACE')
+    flutter_sdk_folder = os.path.join(workspace, 'flutter')
+
+    #
+    # Trigger upgrade on Channel if version is all letters
+    #
+    if flutter_version.isalpha():
+        print_banner("Setting channel to `%s`" % flutter_version)
+        cmd = ['flutter', 'channel', flutter_version]
+        subprocess.check_call(cmd, cwd=flutter_sdk_folder)
+        print_banner("Upgrading")
+        cmd = ['flutter', 'upgrade', '--force']
+        subprocess.check_call(cmd, cwd=flutter_sdk_folder)
+
+    configure_flutter_sdk()
+    save_flutter_bin_cache(flutter_sdk_folder, bin_cache_key, bin_cache_keep)
 
 
 def configure_flutter_sdk():
@@ -930,9 +1567,34 @@ def configure_flutter_sdk():
     subprocess.check_call(cmd)
 
 
+def get_flutter_features_file(flutter_sdk_folder):
+    return os.path.join(flutter_sdk_folder, 'packages', 'flutter_tools', 'lib', 'src', 'features.dart')
+
+
+def get_flutter_tool_fingerprint(flutter_sdk_folder):
+    """ Returns fingerprint of SDK revision and (patched) tool sources """
+    import hashlib
+
+    fingerprint = hashlib.sha256()
+    fingerprint.update(get_git_head(flutter_sdk_folder).encode('utf-8'))
+    fingerprint.update(get_sha256sum(get_flutter_features_file(flutter_sdk_folder)).encode('utf-8'))
+    return fingerprint.hexdigest()
+
+
 def force_tool_rebuild(flutter_sdk_folder):
+    """ Removes tool snapshot if the tool sources changed since it was built """
     tool_script = os.path.join(
         flutter_sdk_folder, 'bin', 'cache', 'flutter_tools.snapshot')
+    tool_stamp = os.path.join(
+        flutter_sdk_folder, 'bin', 'cache', 'flutter_workspace.tool_stamp')
+
+    fingerprint = get_flutter_tool_fingerprint(flutter_sdk_folder)
+
+    if os.path.exists(tool_script) and os.path.exists(tool_stamp):
+        with open(tool_stamp, 'r') as f:
+            if f.read().strip() == fingerprint:
+                print_banner("Flutter Tool is current")
+                return
 
     if os.path.exists(tool_script):
         print_banner("Cleaning Flutter Tool")
@@ -940,14 +1602,122 @@ def force_tool_rebuild(flutter_sdk_folder):
         cmd = ["rm", tool_script]
         subprocess.check_call(cmd, cwd=flutter_sdk_folder)
 
+    # replace rather than rewrite in place
+    make_sure_path_exists(os.path.dirname(tool_stamp))
+    if os.path.exists(tool_stamp):
+        os.remove(tool_stamp)
+    with open(tool_stamp, 'w+') as f:
+        f.write(fingerprint)
+
+
+def get_flutter_bin_cache_key(flutter_sdk_folder):
+    """ Returns snapshot key of SDK revision, engine version and patched tool sources """
+    import hashlib
+
+    engine_version_file = os.path.join(flutter_sdk_folder, 'bin', 'internal', 'engine.version')
+    features_file = get_flutter_features_file(flutter_sdk_folder)
+
+    key = hashlib.sha256()
+    key.update(get_git_head(flutter_sdk_folder).encode('utf-8'))
+    key.update(get_sha256sum(engine_version_file).encode('utf-8'))
+    key.update(get_sha256sum(features_file).encode('utf-8'))
+    return key.hexdigest()[:24]
+
+
+def get_flutter_bin_cache_snapshot_folder():
+    folder = os.path.join(get_cache_folder(), 'flutter-bin-cache')
+    make_sure_path_exists(folder)
+    return folder
+
+
+def get_flutter_bin_cache_marker(flutter_sdk_folder):
+    return os.path.join(flutter_sdk_folder, 'bin', 'cache', 'flutter_workspace.key')
+
+
+def is_flutter_bin_cache_current(flutter_sdk_folder, key):
+    marker = get_flutter_bin_cache_marker(flutter_sdk_folder)
+    if not os.path.exists(marker):
+        return False
+    with open(marker, 'r') as f:
+        return f.read().strip() == key
+
+
+def restore_flutter_bin_cache(flutter_sdk_folder, key) -> bool:
+    """ Populates SDK bin/cache from snapshot matching key.  Returns True if
+    bin/cache is current, meaning tool rebuild and artifact download can be skipped """
+    if not key:
+        return False
+
+    if is_flutter_bin_cache_current(flutter_sdk_folder, key):
+        print_banner("Flutter bin/cache is current")
+        return True
+
+    snapshot_folder = get_flutter_bin_cache_snapshot_folder()
+    snapshot = os.path.join(snapshot_folder, key)
+
+    # keeps other runs from pruning the snapshot while it is copied
+    with file_lock(os.path.join(snapshot_folder, '.lock')):
+        if not os.path.exists(snapshot):
+            return False
+
+        print_banner("Restoring Flutter bin/cache %s" % key)
+        bin_cache = os.path.join(flutter_sdk_folder, 'bin', 'cache')
+        clear_folder(bin_cache)
+        clone_tree(snapshot, bin_cache)
+        os.utime(snapshot)
+    return True
+
+
+def save_flutter_bin_cache(flutter_sdk_folder, key, keep):
+    """ Stores populated SDK bin/cache as snapshot of key, keeping the newest keep snapshots """
+    import glob
+
+    if not key or is_flutter_bin_cache_current(flutter_sdk_folder, key):
+        return
+
+    # replace rather than rewrite in place
+    marker = get_flutter_bin_cache_marker(flutter_sdk_folder)
+    if os.path.exists(marker):
+        os.remove(marker)
+    with open(marker, 'w+') as f:
+        f.write(key)
+
+    snapshot_folder = get_flutter_bin_cache_snapshot_folder()
+    snapshot = os.path.join(snapshot_folder, key)
+    tmp_snapshot = None
+    if not os.path.exists(snapshot):
+        print_banner("Saving Flutter bin/cache %s" % key)
+        tmp_snapshot = '%s.%d.tmp' % (snapshot, os.getpid())
+        clone_tree(os.path.join(flutter_sdk_folder, 'bin', 'cache'), tmp_snapshot)
+        # flutter holds a flock on this file while running
+        lockfile = os.path.join(tmp_snapshot, 'lockfile')
+        if os.path.exists(lockfile):
+            os.remove(lockfile)
+
+    with file_lock(os.path.join(snapshot_folder, '.lock')):
+        if tmp_snapshot:
+            if os.path.exists(snapshot):
+                # another run saved the same key meanwhile
+                clear_folder(tmp_snapshot)
+            else:
+                os.rename(tmp_snapshot, snapshot)
+                note_cache_write(snapshot)
+
+        # skip in progress snapshots of other runs
+        snapshots = [x for x in glob.glob(os.path.join(snapshot_folder, '*')) if '.' not in os.path.basename(x)]
+        snapshots.sort(key=os.path.getmtime, reverse=True)
+        for old_snapshot in snapshots[int(keep):]:
+            print("Removing Flutter bin/cache snapshot %s" % old_snapshot)
+            clear_folder(old_snapshot)
+
 
-def patch_flutter_sdk(flutter_sdk_folder):
+def patch_flutter_sdk(flutter_sdk_folder) -> bool:
+    """ Enables custom devices on all channels.  Idempotent, features.dart is
+    only written if the patch changes it.  Returns True if it was written """
     host = get_host_type()
 
     if host == "linux":
-        print_banner("Patching Flutter SDK")
-
-        cmd = ["bash", "-c", "sed -i -e \"/const Feature flutterCustomDevicesFeature/a const"
+        cmd = ["bash", "-c", "sed -e \"/const Feature flutterCustomDevicesFeature/a const"
                              " Feature flutterCustomDevicesFeature = Feature\\(\\n  name: "
                              "\\\'Early support for custom device types\\\',\\n  configSetting:"
                              " \\\'enable-custom-devices\\\',\\n  environmentOverride: "
@@ -957,21 +1727,81 @@ def patch_flutter_sdk(flutter_sdk_folder):
                              "FeatureChannelSetting(\\n    available: true,\\n  \\)\\n);\" -e "
                              "\"/const Feature flutterCustomDevicesFeature/,/);/d\" packages/"
                              "flutter_tools/lib/src/features.dart"]
-        subprocess.check_call(cmd, cwd=flutter_sdk_folder)
+        patched = subprocess.check_output(cmd, cwd=flutter_sdk_folder)
+
+        features_file = get_flutter_features_file(flutter_sdk_folder)
+        with open(features_file, 'rb') as f:
+            if f.read() == patched:
+                print_banner("Flutter SDK already patched")
+                return False
+
+        print_banner("Patching Flutter SDK")
+        with open(features_file, 'wb') as f:
+            f.write(patched)
+        return True
+
+    return False
+
+
+flutter_repo = 'https://github.com/flutter/flutter.git'
+
+
+def get_flutter_sdk_worktree(version, worktree):
+    """ Checks out Flutter SDK version into worktree, a git worktree of the shared
+    flutter mirror.  Objects are shared; the working tree is not, since the SDK
+    is patched and its bin/cache populated per workspace """
+    mirror_cache = os.path.join(get_cache_folder(), 'git')
+    make_sure_path_exists(mirror_cache)
+    mirror = get_git_mirror_path(mirror_cache, flutter_repo)
+
+    with file_lock(mirror + '.lock'):
+        if not os.path.exists(os.path.join(mirror, 'HEAD')) or not get_git_commit(mirror, version):
+            update_git_mirror(mirror_cache, flutter_repo)
+
+        commit = get_git_commit(mirror, version)
+        if not commit:
+            sys.exit("Flutter SDK version %s not found" % version)
+
+        # a worktree has a .git file, a clone a .git folder
+        if os.path.isfile(os.path.join(worktree, '.git')) and not os.path.islink(worktree):
+            if get_git_head(worktree) != commit:
+                print('Checking out %s' % version)
+                cmd = ['git', 'checkout', '--force', '--detach', commit]
+                subprocess.check_call(cmd, cwd=worktree)
+        else:
+            print('Creating worktree for %s' % version)
+            clear_folder(worktree)
+            make_sure_path_exists(os.path.dirname(worktree))
+            cmd = ['git', 'worktree', 'prune']
+            subprocess.check_call(cmd, cwd=mirror)
+            cmd = ['git', 'worktree', 'add', '--detach', worktree, commit]
+            subprocess.check_call(cmd, cwd=mirror)
+
+    os.utime(mirror)
+    # worktrees are registered in the mirror
+    note_cache_write(mirror)
+    return worktree
 
 
 # Check for flutter SDK path. Pull if exists. Create dir and clone sdk if not.
-def get_flutter_sdk(version):
-    """ Get Flutter SDK clone """
+def get_flutter_sdk(version, shared=True):
+    """ Get Flutter SDK.  Versions are worktrees of the shared flutter mirror, channels are cloned """
 
     workspace = os.environ.get('FLUTTER_WORKSPACE')
 
     flutter_sdk_path = os.path.join(workspace, 'flutter')
 
+    #
+    # Shared worktree
+    #
+    if shared and not version.isalpha():
+
+        get_flutter_sdk_worktree(version, flutter_sdk_path)
+
     #
     # GIT repo
     #
-    if is_repo(flutter_sdk_path):
+    elif os.path.isdir(os.path.join(flutter_sdk_path, '.git')) and not os.path.islink(flutter_sdk_path):
 
         print('Checking out %s' % version)
         cmd = ["git", "fetch", "--all"]
@@ -983,14 +1813,20 @@ def get_flutter_sdk(version):
 
     else:
 
-        flutter_repo = 'https://github.com/flutter/flutter.git'
+        clear_folder(flutter_sdk_path)
 
-        cmd = ['git', 'clone', flutter_repo, flutter_sdk_path]
-        subprocess.check_call(cmd)
+        if shared:
+            # channels are upgraded in place, so they get a local clone of the mirror
+            mirror_cache = os.path.join(get_cache_folder(), 'git')
+            make_sure_path_exists(mirror_cache)
+            clone_repo(workspace, flutter_repo, version, None, mirror_cache, {})
+        else:
+            cmd = ['git', 'clone', flutter_repo, flutter_sdk_path]
+            subprocess.check_call(cmd)
 
-        print('Checking out %s' % version)
-        cmd = ["git", "checkout", version]
-        subprocess.check_call(cmd, cwd=flutter_sdk_path)
+            print('Checking out %s' % version)
+            cmd = ["git", "checkout", version]
+            subprocess.check_call(cmd, cwd=flutter_sdk_path)
 
     print_banner("FLUTTER_SDK: %s" % flutter_sdk_path)
 
@@ -1102,8 +1938,23 @@ def get_engine_sdk_url(runtime, arch):
     return url, commit
 
 
-def get_flutter_engine_artifacts(clean_workspace, runtime, arch):
-    """Downloads Flutter Engine Runtime"""
+# engine-sdk members used by the workspace
+engine_sdk_members = [
+    'engine-sdk/data/icudtl.dat',
+    'engine-sdk/lib/libflutter_engine.so',
+    'engine-sdk/bin/gen_snapshot',
+]
+
+
+def is_engine_sdk_member(name):
+    for member in engine_sdk_members:
+        if name.endswith('/' + member):
+            return True
+    return False
+
+
+def get_flutter_engine_artifacts(clean_workspace, runtime, arch, extract_all=False):
+    """Downloads Flutter Engine Runtime.  Returns bundle folder"""
 
     base_url, engine_version = get_engine_sdk_url(runtime, arch)
 
@@ -1117,44 +1968,116 @@ def get_flutter_engine_artifacts(clean_workspace, runtime, arch):
     sha256_file = os.path.join(cwd_engine, filename + '.sha256')
 
     bundle_folder = os.path.join(cwd, f'bundle-{runtime}-{arch}')
-    os.environ['BUNDLE_FOLDER'] = bundle_folder
-
-    if not compare_sha256(archive_file, sha256_file):
-        print_banner("Downloading Engine artifact")
-        make_sure_path_exists(cwd_engine)
-        if not download_https_file(cwd_engine, base_url, filename,
-                                   None, None, None, None, None, True):
-            print_banner("Engine artifact not available")
-            return
-    else:
-        print_banner("Skipping Engine artifact download")
 
     restore_folder = os.path.join(cwd_engine, f'engine-sdk-{runtime}-{arch}')
-    make_sure_path_exists(restore_folder)
-    subprocess.check_call(['tar', '-xzf', archive_file, '-C', restore_folder])
+
+    member_filter = None if extract_all else is_engine_sdk_member
+
+    # stat only check of a previous extraction and bundle copy; the archive sha256
+    # comes from the digest cache
+    manifest_file = restore_folder + '.manifest.json'
+    previous_manifest = load_json_file(manifest_file)
+    manifest = dict(previous_manifest)
+    archive_sha256 = get_cached_digests(archive_file, ['sha256']).get('sha256')
+    extract_current = (manifest.get('extract_all') == extract_all and
+                       archive_sha256 and manifest.get('archive') == archive_sha256 and
+                       is_file_stamps_current(manifest.get('members')))
+
+    if extract_current:
+        print_banner("Engine %s %s extraction is current" % (runtime, arch))
+    else:
+        extracted = False
+        # the url names the engine commit
+        if not compare_sha256(archive_file, sha256_file) and restore_artifact(archive_file, base_url,
+                                                                              validator='immutable'):
+            write_sha256_file(cwd_engine, filename)
+        if not compare_sha256(archive_file, sha256_file):
+            print_banner("Downloading Engine artifact")
+            make_sure_path_exists(cwd_engine)
+            if member_filter and fetch_https_tarball_members(base_url, archive_file, restore_folder,
+                                                             member_filter, True):
+                store_artifact(archive_file, base_url, validator='immutable')
+                extracted = True
+            elif not download_https_file(cwd_engine, base_url, filename,
+                                         None, None, None, None, None, True):
+                print_banner("Engine artifact not available")
+                return
+        else:
+            print_banner("Skipping Engine artifact download")
+
+        if not extracted:
+            extract_tarball(archive_file, restore_folder, member_filter)
+
+        members = []
+        for root, _dirs, files in os.walk(restore_folder):
+            for name in files:
+                members.append(os.path.join(root, name))
+
+        manifest = {'extract_all': extract_all,
+                    'archive': get_cached_digests(archive_file, ['sha256']).get('sha256'),
+                    'members': get_file_stamps(members),
+                    'bundle': {}}
 
     if clean_workspace:
         if os.path.exists(bundle_folder):
             subprocess.check_output(["rm", "-rf", bundle_folder], cwd=cwd)
 
-    data_folder = os.path.join(bundle_folder, 'data')
-    make_sure_path_exists(data_folder)
+    if not is_file_stamps_current(manifest.get('bundle')):
+        data_folder = os.path.join(bundle_folder, 'data')
+        make_sure_path_exists(data_folder)
+
+        icudtl_src = os.path.join(restore_folder, 'src', 'out', f'linux_{runtime}_{arch}', 'engine-sdk', 'data', 'icudtl.dat')
+
+        lib_folder = os.path.join(bundle_folder, 'lib')
+        make_sure_path_exists(lib_folder)
+
+        libflutter_engine_src = os.path.join(restore_folder, 'src', 'out', f'linux_{runtime}_{arch}', 'engine-sdk', 'lib', 'libflutter_engine.so')
+
+        subprocess.check_call(["cp", icudtl_src, f'{data_folder}'])
+        subprocess.check_call(["cp", libflutter_engine_src, f'{lib_folder}'])
+
+        manifest['bundle'] = get_file_stamps([os.path.join(data_folder, 'icudtl.dat'),
+                                              os.path.join(lib_folder, 'libflutter_engine.so')])
+
+    if manifest != previous_manifest:
+        tmp_file = '%s.%d' % (manifest_file, os.getpid())
+        with open(tmp_file, 'w+') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_file, manifest_file)
 
-    icudtl_src = os.path.join(restore_folder, 'src', 'out', f'linux_{runtime}_{arch}', 'engine-sdk', 'data', 'icudtl.dat')
+    return bundle_folder
 
-    lib_folder = os.path.join(bundle_folder, 'lib')
-    make_sure_path_exists(lib_folder)
 
-    libflutter_engine_src = os.path.join(restore_folder, 'src', 'out', f'linux_{runtime}_{arch}', 'engine-sdk', 'lib', 'libflutter_engine.so')
+def get_flutter_engine_runtime(clean_workspace, archs, max_jobs=None, extract_all=False):
+    """Downloads and extracts release, profile and debug runtimes of each arch concurrently"""
+    import concurrent.futures
+
+    if isinstance(archs, str):
+        archs = archs.split(',')
+
+    jobs = []
+    for arch in archs:
+        for runtime in ['release', 'profile', 'debug']:
+            jobs.append((runtime, arch))
+
+    if not max_jobs:
+        max_jobs = min(len(jobs), os.cpu_count() or 1)
 
-    subprocess.check_call(["cp", icudtl_src, f'{data_folder}'])
-    subprocess.check_call(["cp", libflutter_engine_src, f'{lib_folder}'])
+    bundle_folders = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_jobs) as executor:
+        futures = {}
+        for runtime, arch in jobs:
+            futures[executor.submit(get_flutter_engine_artifacts, clean_workspace, runtime, arch,
+                                    extract_all)] = (runtime, arch)
 
+        for count, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            runtime, arch = futures[future]
+            bundle_folders[(runtime, arch)] = future.result()
+            print('[%d/%d] Engine runtime %s %s' % (count, len(jobs), runtime, arch))
 
-def get_flutter_engine_runtime(clean_workspace, arch):
-    get_flutter_engine_artifacts(clean_workspace, 'release', arch)
-    get_flutter_engine_artifacts(clean_workspace, 'profile', arch)
-    get_flutter_engine_artifacts(clean_workspace, 'debug', arch)
+    # same as sequential order, debug bundle of the first arch is used
+    if bundle_folders.get(('debug', archs[0])):
+        os.environ['BUNDLE_FOLDER'] = bundle_folders[('debug', archs[0])]
 
 
 def handle_conditionals(conditionals, cwd):
@@ -1175,7 +2098,7 @@ def handle_conditionals(conditionals, cwd):
                 subprocess.call(cmd_arr, cwd=cwd)
 
 
-def handle_pre_requisites(obj, cwd):
+def handle_pre_requisites(obj, cwd, ledger=None):
     if not obj:
         return
 
@@ -1192,7 +2115,15 @@ def handle_pre_requisites(obj, cwd):
         if host_specific_pre_requisites.get(host_type):
             distro = host_specific_pre_requisites[host_type]
             handle_conditionals(distro.get('conditionals'), cwd)
+
+            fingerprint = None
+            if ledger is not None:
+                cmds = [os.path.expandvars(cmd) for cmd in distro.get('cmds') or []]
+                fingerprint = get_step_fingerprint(cmds, os.environ, [], cwd)
+                if is_step_done(ledger, 'pre-requisites', fingerprint):
+                    return
             handle_commands(distro.get('cmds'), cwd)
+            record_step(ledger, 'pre-requisites', fingerprint)
         else:
             print('handle_pre_requisites: Not supported')
 
@@ -1240,7 +2171,9 @@ def handle_netrc_obj(obj):
         return True
 
 
-def handle_http_obj(obj, host_machine_arch, cwd, cookie_file, netrc):
+def handle_http_obj(obj, host_machine_arch, cwd, cookie_file, netrc, env=None):
+    """ Downloads the http artifacts of host_machine_arch to cwd.  With env, urls
+    are expanded against env before os.environ """
     if not obj:
         return
 
@@ -1259,38 +2192,147 @@ def handle_http_obj(obj, host_machine_arch, cwd, cookie_file, netrc):
         if 'url' in obj:
             url = obj['url']
 
-        import concurrent.futures
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = []
-            for artifact in host_specific_artifacts:
-                local_url = artifact.get('url')
-                if local_url is None:
-                    local_url = url
+        downloads = []
+        for artifact in host_specific_artifacts:
+            local_url = artifact.get('url')
+            if local_url is None:
+                local_url = url
+
+            base_url = local_url + artifact['endpoint']
+            base_url = os.path.expandvars(base_url) if env is None else expand_env_vars(base_url, env)
+            filename = get_filename_from_url(base_url)
+
+            print(f'url: {base_url}')
+            print(f'filename: {filename}')
+
+            downloads.append({'url': base_url, 'file': filename, 'md5': artifact.get('md5'),
+                              'sha1': artifact.get('sha1'), 'sha256': artifact.get('sha256'),
+                              'segments': artifact.get('segments', obj.get('segments')), 'redirect': True})
 
-                base_url = local_url + artifact['endpoint']
-                base_url = os.path.expandvars(base_url)
-                filename = get_filename_from_url(base_url)
+        download_https_files(cwd, downloads, cookie_file, netrc, obj.get('max_transfers', 8),
+                             on_done=lambda _file, _res: subprocess.check_call(
+                                 ['sudo', '-v'], stdout=subprocess.DEVNULL))
 
-                print(f'url: {base_url}')
-                print(f'filename: {filename}')
 
-                futures.append(executor.submit(download_https_file, cwd, base_url, filename, cookie_file,
-                                               netrc, artifact.get('md5'), artifact.get('sha1'),
-                                               artifact.get('sha256'), True))
-                subprocess.check_call(
-                    ['sudo', '-v'], stdout=subprocess.DEVNULL)
+# environment read by build tools, part of each step fingerprint
+step_env_keys = ['PATH', 'CC', 'CXX', 'CFLAGS', 'CXXFLAGS', 'CPPFLAGS', 'LDFLAGS', 'PKG_CONFIG_PATH',
+                 'LD_LIBRARY_PATH']
 
-            for future in concurrent.futures.as_completed(futures):
-                _res = future.result()
-                subprocess.check_call(
-                    ['sudo', '-v'], stdout=subprocess.DEVNULL)
 
+def load_step_ledger(cwd) -> dict:
+    """ Returns step ledger of a platform working dir """
+    ledger_file = os.path.join(cwd, '.step_ledger.json')
+    return {'file': ledger_file, 'steps': load_json_file(ledger_file)}
+
+
+def save_step_ledger(ledger):
+    tmp_file = ledger['file'] + '.tmp'
+    with open(tmp_file, 'w+') as f:
+        json.dump(ledger['steps'], f, indent=2)
+    os.replace(tmp_file, ledger['file'])
+
+
+def get_step_fingerprint(cmds, env, env_keys, cwd, previous=None, inputs=None) -> str:
+    """ Returns fingerprint of expanded cmds, build environment, cwd, sha256 of
+    files and checkout of git folders named by the cmds, the previous step and
+    the digest of declared inputs """
+    import hashlib
+
+    files = {}
+    heads = {}
+    for path in [str(cwd)] + [value for cmd in cmds for token in shlex.split(cmd)
+                              for value in [token] + token.split('=', 1)[1:]]:
+        path = os.path.normpath(os.path.join(cwd, path))
+        if path in files or path in heads:
+            continue
+        if os.path.isfile(path):
+            files[path] = get_cached_digests(path, ['sha256']).get('sha256')
+        elif os.path.isdir(path):
+            heads[path] = get_git_checkout(path)
+
+    data = {
+        'cmds': cmds,
+        'env': {k: env.get(k) for k in step_env_keys + list(env_keys)},
+        'cwd': str(cwd),
+        'files': files,
+        'heads': heads,
+        'previous': previous,
+        'inputs': inputs,
+    }
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def get_step_inputs(inputs, cwd) -> tuple:
+    """ Returns (digest, mtime) of declared inputs.  An input naming a repo of the
+    app folder is its HEAD and working tree status, otherwise a glob relative to
+    cwd of files taken by path, size and mtime.  mtime is of the newest file,
+    None if a repo is named or no file matched """
+    import glob
+    import hashlib
+
+    app_folder = os.path.join(os.environ.get('FLUTTER_WORKSPACE'), 'app')
+
+    digest = hashlib.sha256()
+    newest = 0
+    for input_ in inputs:
+        input_ = os.path.expandvars(input_)
+
+        repo_folder = os.path.join(app_folder, input_)
+        if '/' not in input_ and os.path.isdir(os.path.join(repo_folder, '.git')):
+            status = get_git_output(['git', 'status', '--porcelain'], repo_folder)
+            digest.update(json.dumps([input_, get_git_head(repo_folder), status]).encode())
+            newest = None
+            continue
+
+        for path in sorted(glob.glob(os.path.join(cwd, input_), recursive=True)):
+            if not os.path.isfile(path):
+                continue
+            st = os.stat(path)
+            digest.update(json.dumps([path, st.st_size, st.st_mtime_ns]).encode())
+            if newest is not None:
+                newest = max(newest, st.st_mtime_ns)
+
+    return digest.hexdigest(), newest or None
+
+
+def get_step_outputs_mtime(outputs, cwd):
+    """ Returns mtime of the oldest output, None if one is missing """
+    mtimes = []
+    for output in outputs:
+        try:
+            mtimes.append(os.stat(os.path.join(cwd, os.path.expandvars(output))).st_mtime_ns)
+        except FileNotFoundError:
+            return None
+    return min(mtimes) if mtimes else None
+
+
+def is_step_done(ledger, key, fingerprint) -> bool:
+    """ True if step key last succeeded with fingerprint, never for a None
+    fingerprint.  Otherwise the step is dropped from the ledger until it
+    succeeds again """
+    if ledger is None:
+        return False
+    if fingerprint and ledger['steps'].get(key) == fingerprint:
+        print('%s unchanged since last run, skipping' % key)
+        return True
+    if ledger['steps'].pop(key, None):
+        save_step_ledger(ledger)
+    return False
+
+
+def record_step(ledger, key, fingerprint):
+    if ledger is None:
+        return
+    ledger['steps'][key] = fingerprint
+    save_step_ledger(ledger)
 
-def handle_commands_obj(cmd_list, cwd):
+
+def handle_commands_obj(cmd_list, cwd, ledger=None):
     if not cmd_list:
         return
 
-    for obj in cmd_list:
+    previous = None
+    for index, obj in enumerate(cmd_list):
         if 'cmds' not in obj:
             continue
 
@@ -1309,9 +2351,11 @@ def handle_commands_obj(cmd_list, cwd):
         if 'env' in obj:
             handle_env(obj.get('env'), local_env)
 
+        created = False
         if 'cwd' in obj:
             cwd = os.path.expandvars(obj.get('cwd'))
             print('cwd: ', cwd)
+            created = not os.path.exists(cwd)
             make_sure_path_exists(cwd)
 
         shell_ = False
@@ -1319,12 +2363,45 @@ def handle_commands_obj(cmd_list, cwd):
             shell_ = obj.get('shell')
 
         cmds = obj.get('cmds')
+
+        inputs_digest, inputs_mtime = None, None
+        if obj.get('inputs'):
+            inputs_digest, inputs_mtime = get_step_inputs(obj.get('inputs'), cwd)
+
+        # a created cwd or a missing output means outputs of an earlier run are gone
+        outputs_mtime = None
+        if 'outputs' in obj:
+            outputs_mtime = get_step_outputs_mtime(obj.get('outputs'), cwd)
+            created = created or outputs_mtime is None
+
+        key = 'post_cmds/%d' % index
+        fingerprint = None
+        recorded = False
+        if ledger is not None:
+            fingerprint = get_step_fingerprint([os.path.expandvars(cmd) for cmd in cmds], local_env,
+                                               obj.get('env', {}).keys(), cwd, previous, inputs_digest)
+            previous = fingerprint
+            recorded = key in ledger['steps']
+            if is_step_done(ledger, key, None if created else fingerprint):
+                continue
+
+        # make style; without a recorded run, outputs newer than all inputs are current.
+        # Without matched input files only the ledger can tell
+        if not created and not recorded and outputs_mtime is not None and inputs_mtime is not None \
+                and outputs_mtime >= inputs_mtime:
+            print('%s outputs are newer than its inputs, skipping' % key)
+            record_step(ledger, key, fingerprint)
+            continue
+
         for cmd in cmds:
             expanded_cmd = os.path.expandvars(cmd)
             cmd_arr = shlex.split(expanded_cmd)
             print('cmd: %s' % cmd_arr)
             subprocess.check_call(cmd_arr, cwd=cwd, env=local_env, shell=shell_)
 
+        record_step(ledger, key, fingerprint)
+        record_git_tree(cwd)
+
 
 def handle_commands(cmds, cwd):
     if cmds:
@@ -1505,6 +2582,11 @@ def handle_github_obj(obj, cwd, token):
 
         artifacts = get_github_workflow_artifacts(token, owner, repo, run_id)
 
+        # artifacts installed by previous runs
+        record_file = os.path.join(cwd, '.github_artifacts.json')
+        record = load_json_file(record_file)
+        installed = {}
+
         for artifact in artifacts:
 
             name = artifact.get('name')
@@ -1513,32 +2595,88 @@ def handle_github_obj(obj, cwd, token):
             for artifact_name in artifact_names:
 
                 if artifact_name == name:
+                    entry = record.get(name, {})
+                    if (entry.get('id') == artifact.get('id') and entry.get('digest') == artifact.get('digest') and
+                            is_file_stamps_current(entry.get('files'))):
+                        print("Skipping %s, run_id: %s is installed" % (name, run_id))
+                        continue
+
                     url = artifact.get('archive_download_url')
 
                     print("Downloading %s run_id: %s via %s" %
                           (workflow, run_id, url))
 
-                    filename = "%s.zip" % name
-                    downloaded_file = get_github_artifact(token, url, filename)
-                    if downloaded_file is None:
-                        print_banner("Failed to download %s" % filename)
+                    files = get_github_artifact_files(token, url, name, cwd)
+                    if files is None:
+                        print_banner("Failed to download %s.zip" % name)
                         continue
 
-                    print("Downloaded: %s" % downloaded_file)
-
-                    with zipfile.ZipFile(downloaded_file, "r") as zip_ref:
-                        zip_ref.extractall(str(cwd))
-
-                    cmd = ["rm", downloaded_file]
-                    subprocess.check_output(cmd)
+                    installed[name] = {'id': artifact.get('id'), 'run_id': run_id,
+                                       'digest': artifact.get('digest'), 'files': files}
                     continue
 
+        if not installed:
+            return
+
         if post_process:
             for cmd in post_process:
                 expanded_cmd = os.path.expandvars(cmd)
                 cmd_arr = shlex.split(expanded_cmd)
                 subprocess.call(cmd_arr, cwd=cwd, env=os.environ)
 
+        # stamped after post_process so its changes don't invalidate the record
+        for name, entry in installed.items():
+            entry['files'] = get_file_stamps(entry['files'])
+            record[name] = entry
+        with open(record_file, 'w+') as f:
+            json.dump(record, f, indent=2)
+
+
+def get_github_artifact_files(token, url, name, cwd):
+    """ Extracts artifact zip to cwd.  Returns list of extracted files, None on failure.
+    A stored copy is extracted in place, otherwise the zip is fetched and extracted """
+
+    # the url names one artifact id
+    stored = find_artifact(url, validator='immutable')
+    if stored:
+        print("** Using %s.zip from artifact store" % name)
+        try:
+            return extract_zip_file(stored, str(cwd))
+        except (zipfile.BadZipFile, ValueError) as e:
+            print_banner("Extracting %s failed: %s" % (stored, e))
+            return None
+
+    # the archive is only kept on disk to feed the artifact store
+    tee_file = None
+    if is_artifact_store_enabled():
+        tee_file = "%s/%s.zip" % (get_workspace_tmp_folder(), name)
+
+    headers = ['Authorization: token %s' % token]
+    files = fetch_https_zip_members(url, headers, str(cwd), tee_file)
+    if files is not None:
+        if tee_file:
+            store_artifact(tee_file, url, validator='immutable', move=True)
+            if os.path.exists(tee_file):
+                os.remove(tee_file)
+        return files
+
+    # retry through the plain download
+    downloaded_file = get_github_artifact(token, url, "%s.zip" % name)
+    if not downloaded_file:
+        return None
+
+    print("Downloaded: %s" % downloaded_file)
+
+    try:
+        files = extract_zip_file(downloaded_file, str(cwd))
+    except (zipfile.BadZipFile, ValueError) as e:
+        print_banner("Extracting %s failed: %s" % (downloaded_file, e))
+        files = None
+
+    cmd = ["rm", downloaded_file]
+    subprocess.check_output(cmd)
+    return files
+
 
 def handle_artifacts_obj(obj, host_machine_arch, cwd, git_token, cookie_file):
     if not obj:
@@ -1574,6 +2712,28 @@ def handle_dotenv(dotenv_files):
             print("Loaded: %s" % dotenv_path)
 
 
+def expand_env_vars(value, env):
+    """ os.path.expandvars, looking up env before os.environ """
+    import re
+
+    def lookup(match):
+        name = match.group(1) or match.group(2)
+        if name in env:
+            return env[name]
+        return os.environ.get(name, match.group(0))
+
+    return re.sub(r'\$(?:(\w+)|\{([^}]*)\})', lookup, value)
+
+
+def get_platform_env(env_variables) -> dict:
+    """ Returns env values of a platform as handle_env would set them, leaving
+    os.environ untouched """
+    env = {}
+    for k, v in (env_variables or {}).items():
+        env[k] = expand_env_vars(v, env)
+    return env
+
+
 def handle_env(env_variables, local_env):
     if not env_variables:
         return
@@ -1647,8 +2807,9 @@ def is_host_type_supported(host_types):
     return True
 
 
-def setup_platform(platform_, git_token, cookie_file, plex):
-    """ Sets up platform """
+def setup_platform(platform_, git_token, cookie_file, plex, step_ledger=True):
+    """ Sets up platform.  With step_ledger, pre-requisites and post_cmds steps
+    that are unchanged since their last success are skipped """
 
     if platform_['id'] in plex:
         print_banner("PLEX - %s" % platform_['id'])
@@ -1684,7 +2845,8 @@ def setup_platform(platform_, git_token, cookie_file, plex):
     handle_artifacts_obj(runtime.get('artifacts'),
                          host_machine_arch, cwd, git_token, cookie_file)
     subprocess.check_call(['sudo', '-v'], stdout=subprocess.DEVNULL)
-    handle_pre_requisites(runtime.get('pre-requisites'), cwd)
+    ledger = load_step_ledger(cwd) if step_ledger else None
+    handle_pre_requisites(runtime.get('pre-requisites'), cwd, ledger)
     subprocess.check_call(['sudo', '-v'], stdout=subprocess.DEVNULL)
     handle_docker_obj(runtime.get('docker'), host_machine_arch, cwd)
     subprocess.check_call(['sudo', '-v'], stdout=subprocess.DEVNULL)
@@ -1693,24 +2855,177 @@ def setup_platform(platform_, git_token, cookie_file, plex):
     handle_qemu_obj(runtime.get('qemu'), cwd, platform_[
         'id'], platform_['flutter_runtime'])
     subprocess.check_call(['sudo', '-v'], stdout=subprocess.DEVNULL)
-    handle_commands_obj(runtime.get('post_cmds'), cwd)
+    handle_commands_obj(runtime.get('post_cmds'), cwd, ledger)
 
     handle_custom_devices(platform_)
 
 
-def setup_platforms(platforms, git_token, cookie_file, plex):
-    """ Sets up each occurring platform defined """
+def is_platform_supported(platform_) -> bool:
+    return (get_host_machine_arch() in platform_['supported_archs'] and
+            is_host_type_supported(platform_['supported_host_types']))
+
 
-    if plex:
-        plex = plex.split(" ")
+def prefetch_platform_artifacts(platforms, git_token, cookie_file, plex):
+    """ Downloads the http artifacts of each platform to its working dir while repos
+    are still syncing.  Platforms loading a dotenv file are left to their setup, the
+    file may live in a repo.  A failure is reported only, setup fetches what is
+    missing """
+    host_machine_arch = get_host_machine_arch()
+    workspace = os.environ.get('FLUTTER_WORKSPACE')
 
     for platform_ in platforms:
-        setup_platform(platform_, git_token, cookie_file, plex)
+        artifacts = platform_['runtime'].get('artifacts') or {}
+        if (platform_['id'] in plex or not artifacts.get('http') or platform_.get('dotenv') or
+                not is_platform_supported(platform_)):
+            continue
+
+        cwd = os.path.join(workspace, '.config', 'flutter_workspace', platform_['id'], 'artifacts')
+        make_sure_path_exists(cwd)
+
+        print_banner("Prefetching Artifacts of %s" % platform_['id'])
+        try:
+            netrc = handle_netrc_obj(artifacts.get('netrc'))
+            handle_http_obj(artifacts['http'], host_machine_arch, cwd, cookie_file or artifacts.get('cookie_file'),
+                            netrc, get_platform_env(platform_.get('env')))
+        except (Exception, SystemExit) as e:
+            print_banner("Prefetch of %s failed: %s" % (platform_['id'], e))
+
+
+def get_platform_repos(platform_, repos) -> list:
+    """ Returns uris of the repos a platform references as app/<repo folder>, or
+    by folder name in post_cmds inputs.  A reference to the app folder itself
+    means every repo """
+    import re
+
+    uris = {get_repo_name(repo['uri']): repo['uri'] for repo in repos if repo.get('uri')}
+
+    text = json.dumps(platform_)
+    if re.search(r'/app/?(?![\w./-])', text):
+        return list(uris.values())
+
+    names = set(re.findall(r'/app/([\w.-]+)', text))
+    for obj in platform_['runtime'].get('post_cmds') or []:
+        names.update(obj.get('inputs') or [])
+
+    return [uri for name, uri in uris.items() if name in names]
 
-        # reset sudo timeout
-        subprocess.check_call(['sudo', '-v'], stdout=subprocess.DEVNULL)
 
-    print_banner("Platform Setup Complete")
+def get_platform_tasks(platforms, repos, git_token, cookie_file, plex, parallel, step_ledger, deps) -> list:
+    """ Returns a setup task per platform, id 'platform:<id>'.  Each waits on deps,
+    the repos it references and the platforms of get_platform_dependencies.  With
+    parallel, platforms are set up in child processes """
+    import threading
+    from functools import partial
+
+    output_lock = threading.Lock()
+    dependencies = get_platform_dependencies(platforms)
+
+    tasks = []
+    for platform_ in platforms:
+        if parallel:
+            fn = partial(setup_platform_process, platform_, git_token, cookie_file, plex, step_ledger, output_lock)
+        else:
+            fn = partial(setup_platform, platform_, git_token, cookie_file, plex, step_ledger)
+        tasks.append({'id': 'platform:' + platform_['id'], 'slot': 'platforms', 'fn': fn,
+                      'deps': deps + get_platform_repos(platform_, repos) +
+                      ['platform:' + id_ for id_ in dependencies[platform_['id']]]})
+    return tasks
+
+
+def get_platform_dependencies(platforms) -> dict:
+    """ Returns platform ids each platform waits on.  Without depends_on, platforms
+    of '_' prefixed files keep their sorted order and precede all others """
+    ids = [platform_['id'] for platform_ in platforms]
+    prefixed = [platform_['id'] for platform_ in platforms
+                if platform_.get('config_file', '').startswith('_')]
+
+    dependencies = {}
+    for platform_ in platforms:
+        id_ = platform_['id']
+        if 'depends_on' in platform_:
+            deps = []
+            for dep in platform_['depends_on']:
+                if dep in ids:
+                    deps.append(dep)
+                else:
+                    print("%s: depends_on %s is not loaded, ignoring" % (id_, dep))
+        elif id_ in prefixed:
+            deps = prefixed[:prefixed.index(id_)][-1:]
+        else:
+            deps = list(prefixed)
+        dependencies[id_] = deps
+
+    return dependencies
+
+
+def get_platform_log_file(platform_id) -> str:
+    return os.path.join(os.environ.get('FLUTTER_WORKSPACE'), '.config', 'flutter_workspace', platform_id,
+                        'setup.log')
+
+
+def setup_platform_child(platform_, git_token, cookie_file, plex, step_ledger, log_file, settings, conn):
+    """ Child process of a platform.  Output goes to log_file, the resulting
+    environment changes are sent back over conn """
+    fd = os.open(log_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    os.dup2(fd, sys.stdout.fileno())
+    os.dup2(fd, sys.stderr.fileno())
+    os.close(fd)
+    # keep prints in order with subprocess output
+    sys.stdout.reconfigure(line_buffering=True)
+
+    apply_download_settings(settings)
+
+    env = dict(os.environ)
+    setup_platform(platform_, git_token, cookie_file, plex, step_ledger)
+    save_digest_cache()
+    sys.stdout.flush()
+
+    changed = {k: v for k, v in os.environ.items() if env.get(k) != v}
+    removed = [k for k in env if k not in os.environ]
+    conn.send((changed, removed, sorted(cache_writes)))
+    conn.close()
+
+
+def setup_platform_process(platform_, git_token, cookie_file, plex, step_ledger, output_lock):
+    """ Sets up platform in a child process, then prints its log in one piece and
+    applies its environment changes so dependent platforms see them """
+    import multiprocessing
+
+    log_file = get_platform_log_file(platform_['id'])
+    make_sure_path_exists(os.path.dirname(log_file))
+
+    # spawn, forking a threaded process may deadlock the child
+    ctx = multiprocessing.get_context('spawn')
+    reader, writer = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=setup_platform_child,
+                          args=(platform_, git_token, cookie_file, plex, step_ledger, log_file,
+                                get_download_settings(), writer))
+    process.start()
+    writer.close()
+
+    result = None
+    try:
+        result = reader.recv()
+    except EOFError:
+        pass
+    process.join()
+
+    with output_lock:
+        print_banner("Platform %s - %s" % (platform_['id'], log_file))
+        with open(log_file, 'r', errors='replace') as f:
+            for line in f:
+                sys.stdout.write(line)
+        sys.stdout.flush()
+
+    if process.exitcode != 0 or result is None:
+        raise RuntimeError("exit code %s, see %s" % (process.exitcode, log_file))
+
+    changed, removed, written = result
+    os.environ.update(changed)
+    for key in removed:
+        os.environ.pop(key, None)
+    # chowned by the parent, see chown_cache_entries
+    cache_writes.update(written)
 
 
 def base64_to_string(b):
@@ -1718,18 +3033,69 @@ def base64_to_string(b):
     return base64.b64decode(b).decode('utf-8')
 
 
-def get_github_json(token, url):
-    """Function to return the JSON of GitHub REST API"""
+def get_github_api_cache_file(token, url) -> str:
+    """ Returns cache file of a GitHub REST API response, keyed by token and url """
+    import hashlib
+
+    folder = os.path.join(get_cache_folder(), 'github_api')
+    make_sure_path_exists(folder)
+    key = hashlib.sha256(('%s %s' % (token, url)).encode('utf-8')).hexdigest()
+    return os.path.join(folder, key + '.json')
+
+
+def get_github_json_page(token, url):
+    """ Returns (JSON, next page url) of GitHub REST API.  Responses are cached with their
+    ETag and revalidated with If-None-Match; a 304 doesn't count against the rate limit """
     import pycurl
 
+    cache_file = get_github_api_cache_file(token, url)
+    cached = load_json_file(cache_file)
+
+    headers = ["Accept: application/vnd.github+json", "Authorization: Bearer %s" % token]
+    if cached.get('etag'):
+        headers.append('If-None-Match: %s' % cached['etag'])
+
+    response = {}
+
+    def header(line):
+        line = line.decode('iso-8859-1').strip()
+        if ':' in line:
+            name, value = line.split(':', 1)
+            response[name.strip().lower()] = value.strip()
+
     c = pycurl.Curl()
     c.setopt(pycurl.URL, url)
-    c.setopt(pycurl.HTTPHEADER, [
-        "Accept: application/vnd.github+json", "Authorization: Bearer %s" % token])
+    c.setopt(pycurl.HTTPHEADER, headers)
+    c.setopt(pycurl.HEADERFUNCTION, header)
     buffer = io.BytesIO()
     c.setopt(pycurl.WRITEDATA, buffer)
     c.perform()
-    return json.loads(buffer.getvalue().decode('utf-8'))
+    status = c.getinfo(pycurl.HTTP_CODE)
+    c.close()
+
+    if status == 304:
+        return cached.get('body'), cached.get('next')
+
+    data = json.loads(buffer.getvalue().decode('utf-8'))
+
+    next_url = None
+    for link in response.get('link', '').split(','):
+        if 'rel="next"' in link:
+            next_url = link.split(';')[0].strip().strip('<>')
+
+    if status == 200 and response.get('etag'):
+        tmp_file = '%s.%d' % (cache_file, os.getpid())
+        with open(tmp_file, 'w+') as f:
+            json.dump({'etag': response['etag'], 'body': data, 'next': next_url}, f)
+        os.replace(tmp_file, cache_file)
+        note_cache_write(cache_file)
+
+    return data, next_url
+
+
+def get_github_json(token, url):
+    """Function to return the JSON of GitHub REST API"""
+    return get_github_json_page(token, url)[0]
 
 
 def get_github_artifact_list_json(token, url):
@@ -1748,39 +3114,43 @@ def get_github_artifact_list_json(token, url):
 
 
 def get_github_workflow_runs(token, owner, repo, workflow):
-    """ Gets workflow run list """
+    """ Yields workflow runs, newest first.  Pages are requested as iteration reaches them """
 
     url = "https://api.github.com/repos/%s/%s/actions/workflows/%s/runs" % (
         owner, repo, workflow)
 
-    data = get_github_json(token, url)
-
-    if 'workflow_runs' in data:
-        return data.get('workflow_runs')
+    while url:
+        data, url = get_github_json_page(token, url)
 
-    if 'message' in data:
-        sys.exit("[get_github_workflow_runs] GitHub Message: %s" %
-                 data.get('message'))
+        if 'workflow_runs' not in data:
+            if 'message' in data:
+                sys.exit("[get_github_workflow_runs] GitHub Message: %s" %
+                         data.get('message'))
+            return
 
-    return {}
+        for run in data.get('workflow_runs'):
+            yield run
 
 
 def get_github_workflow_artifacts(token, owner, repo, id_):
     """ Get Workflow Artifact List """
 
-    url = "https://api.github.com/repos/%s/%s/actions/runs/%s/artifacts" % (
+    url = "https://api.github.com/repos/%s/%s/actions/runs/%s/artifacts?per_page=100" % (
         owner, repo, id_)
 
-    data = get_github_json(token, url)
+    artifacts = []
+    while url:
+        data, url = get_github_json_page(token, url)
 
-    if 'artifacts' in data:
-        return data.get('artifacts')
+        if 'artifacts' not in data:
+            if 'message' in data:
+                sys.exit("[get_github_workflow_artifacts] GitHub Message: %s" %
+                         data.get('message'))
+            break
 
-    if 'message' in data:
-        sys.exit("[get_github_workflow_artifacts] GitHub Message: %s" %
-                 data.get('message'))
+        artifacts.extend(data.get('artifacts'))
 
-    return {}
+    return artifacts
 
 
 def get_workspace_tmp_folder() -> str:
@@ -1796,57 +3166,63 @@ def get_github_artifact(token: str, url: str, filename: str) -> str:
 
     tmp_file = "%s/%s" % (get_workspace_tmp_folder(), filename)
 
+    if restore_artifact(tmp_file, url, validator='immutable'):
+        return tmp_file
+
     headers = ['Authorization: token %s' % token]
     if fetch_https_binary_file(url, tmp_file, True, headers, None, False):
+        store_artifact(tmp_file, url, validator='immutable')
         return tmp_file
 
     return ''
 
 
-def ubuntu_is_pkg_installed(package: str) -> bool:
-    """Ubuntu - checks if package is installed"""
+# names and provides of installed host packages, see get_installed_packages
+installed_packages = set()
 
-    cmd = "dpkg-query -W --showformat='${Status}' %s" % package
-    ps = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    result = ps.communicate()[0]
 
-    if isinstance(result, bytes):
-        result = result.decode()
+def get_installed_packages(os_release_id: str) -> set:
+    """Returns names and provides of installed packages, queried once per run"""
+    if installed_packages:
+        return installed_packages
 
-    if 'install ok installed' in result:
-        print("Package %s Found" % package)
-        return True
+    if os_release_id == 'ubuntu':
+        cmd = ['dpkg-query', '-W', '--showformat=${Status}\t${Package}\t${Provides}\n']
     else:
-        print("Package %s Not Found" % package)
-        return False
+        cmd = ['rpm', '-qa', '--queryformat', '%{NAME}\n[%{PROVIDES}\n]']
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
 
+    for line in result.stdout.splitlines():
+        if os_release_id != 'ubuntu':
+            installed_packages.add(line.strip())
+            continue
 
-def ubuntu_install_pkg_if_not_installed(package):
-    """Ubuntu - Installs package if not already installed"""
-    if not ubuntu_is_pkg_installed(package):
-        print("\n* Installing runtime package dependency: %s" % package)
-
-        cmd = ["sudo", "apt-get", "install", "-y", package]
-        subprocess.call(cmd)
-
+        fields = line.split('\t')
+        if len(fields) != 3 or fields[0] != 'install ok installed':
+            continue
+        installed_packages.add(fields[1])
+        for provide in fields[2].split(','):
+            installed_packages.add(provide.split('(')[0].strip())
 
-def get_dnf_installed(filter_: str) -> str:
-    """Returns dnf package list if present, None otherwise"""
+    installed_packages.discard('')
+    return installed_packages
 
-    cmd = 'dnf list installed |grep %s' % filter_
-    ps = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    result = ps.communicate()[0]
 
-    if isinstance(result, bytes):
-        result = result.decode()
+def ubuntu_is_pkg_installed(package: str) -> bool:
+    """Ubuntu - checks if package is installed"""
 
-    return result
+    if package in get_installed_packages('ubuntu'):
+        print("Package %s Found" % package)
+        return True
+    else:
+        print("Package %s Not Found" % package)
+        return False
 
 
 def fedora_is_pkg_installed(package: str) -> bool:
     """Fedora - checks if package is installed"""
 
-    if package in get_dnf_installed(package):
+    if package in get_installed_packages('fedora'):
         print("Package %s Found" % package)
         return True
     else:
@@ -1854,13 +3230,30 @@ def fedora_is_pkg_installed(package: str) -> bool:
         return False
 
 
-def fedora_install_pkg_if_not_installed(package: str):
-    """Fedora - Installs package if not already installed"""
-    if not fedora_is_pkg_installed(package):
-        print("\n* Installing runtime package dependency: %s" % package)
+def install_pkgs(install_cmd: list, packages: list):
+    """Installs packages in one transaction.  If it fails, e.g. a package is not
+    available, each package is installed on its own"""
+    print("\n* Installing runtime package dependencies: %s" % ' '.join(packages))
 
-        cmd = ["sudo", "dnf", "install", "-y", package]
-        subprocess.call(cmd)
+    if subprocess.call(install_cmd + packages) and len(packages) > 1:
+        for package in packages:
+            subprocess.call(install_cmd + [package])
+
+    installed_packages.clear()
+
+
+def ubuntu_install_pkgs_if_not_installed(packages: list):
+    """Ubuntu - Installs packages that are not already installed"""
+    missing = [package for package in packages if not ubuntu_is_pkg_installed(package)]
+    if missing:
+        install_pkgs(["sudo", "apt-get", "install", "-y"], missing)
+
+
+def fedora_install_pkgs_if_not_installed(packages: list):
+    """Fedora - Installs packages that are not already installed"""
+    missing = [package for package in packages if not fedora_is_pkg_installed(package)]
+    if missing:
+        install_pkgs(["sudo", "dnf", "install", "-y"], missing)
 
 
 def is_linux_host_kvm_capable() -> bool:
@@ -1944,15 +3337,13 @@ def install_minimum_runtime_deps():
             cmd = ['sudo', 'apt', 'update', '-y']
             subprocess.check_output(cmd)
             packages = 'git git-lfs curl libcurl4-openssl-dev libssl-dev libgtk-3-dev python3.8-venv python3-pycurl python3-toml python3-dotenv'.split(' ')
-            for package in packages:
-                ubuntu_install_pkg_if_not_installed(package)
+            ubuntu_install_pkgs_if_not_installed(packages)
 
         elif os_release_id == 'fedora':
             cmd = ['sudo', 'dnf', '-y', 'update']
             subprocess.check_output(cmd)
             packages = 'dnf-plugins-core git git-lfs curl libcurl-devel openssl-devel gtk3-devel python3-virtualenv python3-pycurl python3-toml python3-dotenv'.split(' ')
-            for package in packages:
-                fedora_install_pkg_if_not_installed(package)
+            fedora_install_pkgs_if_not_installed(packages)
 
     elif host_type == "darwin":
         brew_path = get_mac_brew_path()
@@ -2044,10 +3435,7 @@ def get_engine_commit(version, hash_):
 
 def get_launch_obj(repo, device_id):
     """returns dictionary of launch target"""
-    uri = repo.get('uri')
-    repo_name = uri.rsplit('/', 1)[-1]
-    repo_name = repo_name.split(".")
-    repo_name = repo_name[0]
+    repo_name = get_repo_name(repo.get('uri'))
 
     pubspec_path = repo.get('pubspec_path')
     if pubspec_path is not None: